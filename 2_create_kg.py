@@ -3,12 +3,32 @@
 # root causes, impact areas, and comments.
 # It also establishes relationships between these nodes.
 # The script uses the Neo4j Python driver to connect to the database and execute Cypher queries.
+# The CSV file is streamed once. Rows are grouped into batches and every batch is
+# written with parameterized `UNWIND $rows` statements inside a single write
+# transaction, together with the ticket-to-ticket edges whose tickets both exist.
+# With LOAD_WORKERS > 1 the batches are written in parallel by a pool of sessions
+# sharing one driver.
+# With LOAD_MODE=sync only new and changed tickets are written, by comparing the
+# per-section fingerprints stored on each Ticket, and tickets missing from the CSV
+# are retired.
+# Every written ticket also gets a context document (t.context) rendering its
+# sections, stamped with the ticket version it was built at (t.context_version), so
+# the question answering app reads one property instead of traversing the sections.
+# LOAD_MODE=contexts only rebuilds the documents that are missing or out of date.
 
 from dotenv import load_dotenv
 import os
+import sys
 import csv
 import json
+import time
+import hashlib
+import random
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from neo4j import GraphDatabase
+from neo4j.exceptions import TransientError
+from kg_schema import bootstrap_schema
+from cypher_templates import TICKET_CONTEXT_QUERY
 
 load_dotenv()
 
@@ -22,270 +42,723 @@ AUTH = (NEO4J_USERNAME, NEO4J_PASSWORD)
 driver = GraphDatabase.driver(NEO4J_URI, auth=AUTH, database=NEO4J_DATABASE)
 
 CSV_FILE_NAME = os.environ["CSV_FILE_NAME"]
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "500"))
+LOAD_WORKERS = int(os.environ.get("LOAD_WORKERS", "1"))
+MAX_RETRIES = int(os.environ.get("MAX_RETRIES", "5"))
+LOAD_MODE = os.environ.get("LOAD_MODE", "full")
+
+# Ticket properties holding the fingerprint of each section
+FINGERPRINT_KEYS = [
+    "summary_hash",
+    "description_hash",
+    "step_hash",
+    "comments_hash",
+    "attributes_hash",
+]
+
+# Outgoing relationships owned by a ticket, rebuilt when the ticket changes
+TICKET_RELATIONSHIPS = [
+    "HAS_SUMMARY",
+    "HAS_ISSUE_DESCRIPTION",
+    "HAS_STEPS_TO_REPRODUCE",
+    "HAS_PRIORITY",
+    "HAS_ROOT_CAUSE",
+    "HAS_IMPACT_AREA",
+    "HAS_COMMENTS",
+    "CLONE_FROM",
+    "CLONE_TO",
+    "SIMILAR_TO",
+]
+
+
+# Function to compute the key of a text node from its content
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# Function to convert a CSV row into the parameter map used by the UNWIND queries
+def parse_row(row):
+    parsed = {
+        "code": row["Code"],
+        "title": row["Title"],
+        "summary": row["Summary"],
+        "summary_hash": text_hash(row["Summary"]),
+        "description": row["Issue_Description"],
+        "description_hash": text_hash(row["Issue_Description"]),
+        "step": row["Step_To_Reproduce"],
+        "step_hash": text_hash(row["Step_To_Reproduce"]),
+        "priority": row["Priority"],
+        "root_cause": row["Root_Cause"],
+        "impact_area": row["Impact_Area"],
+        "comments": row["Comments"],
+        "comments_hash": text_hash(row["Comments"]),
+        "clone_from": json.loads(row["Clone_From"]),
+        "clone_to": json.loads(row["Clone_To"]),
+        "similar_to": json.loads(row["Similar_To"]),
+    }
+    parsed["attributes_hash"] = text_hash(
+        json.dumps(
+            [
+                parsed["title"],
+                parsed["priority"],
+                parsed["root_cause"],
+                parsed["impact_area"],
+                parsed["clone_from"],
+                parsed["clone_to"],
+                parsed["similar_to"],
+            ]
+        )
+    )
+    parsed["fingerprint"] = text_hash("".join(parsed[key] for key in FINGERPRINT_KEYS))
+    return parsed
+
 
+# Function to read the CSV file in batches of parsed rows
+def read_batches(csv_file_name, batch_size):
+    # Exported descriptions and comments can exceed the default field limit
+    csv.field_size_limit(sys.maxsize)
+    with open(csv_file_name, mode="r", newline="", encoding="utf-8") as file:
+        reader = csv.DictReader(file)
+        print("Reading CSV file...")
 
-# Function to connect and run a Cypher query
-def execute_query(driver, cypher_query, parameters=None):
-    try:
-        with driver.session(database=NEO4J_DATABASE) as session:
-            session.run(cypher_query, parameters)
-    except Exception as e:
-        print(f"Error: {e}")
+        batch = []
+        for row in reader:
+            batch.append(parse_row(row))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
 
 
 # Function to create ticket nodes
-def create_ticket_node(driver, code, title):
-    print("Creating ticket node")
+def create_ticket_nodes(tx, rows):
     create_provider_query = """
-    MERGE (t:Ticket {code: $code, title: $title})
+    UNWIND $rows AS row
+    MERGE (t:Ticket {code: row.code})
+    SET t.version = CASE
+            WHEN t.fingerprint = row.fingerprint THEN t.version
+            ELSE coalesce(t.version, 0) + 1
+        END,
+        t.title = row.title,
+        t.fingerprint = row.fingerprint,
+        t.summary_hash = row.summary_hash,
+        t.description_hash = row.description_hash,
+        t.step_hash = row.step_hash,
+        t.comments_hash = row.comments_hash,
+        t.attributes_hash = row.attributes_hash
     """
-    parameters = {"code": code, "title": title}
-    execute_query(driver, create_provider_query, parameters)
+    tx.run(create_provider_query, rows=rows)
 
 
 # Function to create summary nodes
-def create_summary_node(driver, summary):
-    print("Creating summary node")
+def create_summary_nodes(tx, rows):
     create_provider_query = """
-    MERGE (s:Summary {summary: $summary})
+    UNWIND $rows AS row
+    MERGE (s:Summary {hash: row.summary_hash})
+    ON CREATE SET s.summary = row.summary
+    SET s.ticket_code = row.code
     """
-    parameters = {"summary": summary}
-    execute_query(driver, create_provider_query, parameters)
+    tx.run(create_provider_query, rows=rows)
 
 
 # Function to create issue description nodes
-def create_issue_description_node(driver, issue_description_text):
-    print("Creating issue description node")
+def create_issue_description_nodes(tx, rows):
     create_provider_query = """
-    MERGE (id:IssueDescription {description: $description})
+    UNWIND $rows AS row
+    MERGE (id:IssueDescription {hash: row.description_hash})
+    ON CREATE SET id.description = row.description
+    SET id.ticket_code = row.code
     """
-    parameters = {"description": issue_description_text}
-    execute_query(driver, create_provider_query, parameters)
+    tx.run(create_provider_query, rows=rows)
 
 
 # Function to create step to reproduce nodes
-def create_step_reproduce_node(driver, step_reproduce_text):
-    print("Creating step to reproduce node")
+def create_step_reproduce_nodes(tx, rows):
     create_provider_query = """
-    MERGE (sr:StepReproduce {step: $step})
+    UNWIND $rows AS row
+    MERGE (sr:StepReproduce {hash: row.step_hash})
+    ON CREATE SET sr.step = row.step
+    SET sr.ticket_code = row.code
     """
-    parameters = {"step": step_reproduce_text}
-    execute_query(driver, create_provider_query, parameters)
+    tx.run(create_provider_query, rows=rows)
 
 
 # Function to create priority nodes
-def create_priority_node(driver, priority_text):
-    print("Creating priority node")
+def create_priority_nodes(tx, rows):
     create_provider_query = """
-    MERGE (p:Priority {priority: $priority})
+    UNWIND $rows AS row
+    MERGE (p:Priority {priority: row.priority})
     """
-    parameters = {"priority": priority_text}
-    execute_query(driver, create_provider_query, parameters)
+    tx.run(create_provider_query, rows=rows)
 
 
 # Function to create root cause nodes
-def create_root_cause_node(driver, root_cause_text):
-    print("Creating root cause node")
+def create_root_cause_nodes(tx, rows):
     create_provider_query = """
-    MERGE (rc:RootCause {root_cause: $root_cause})
+    UNWIND $rows AS row
+    MERGE (rc:RootCause {root_cause: row.root_cause})
     """
-    parameters = {"root_cause": root_cause_text}
-    execute_query(driver, create_provider_query, parameters)
+    tx.run(create_provider_query, rows=rows)
 
 
 # Function to create impact area nodes
-def create_impact_area_node(driver, impact_area_text):
-    print("Creating impact area node")
+def create_impact_area_nodes(tx, rows):
     create_provider_query = """
-    MERGE (ia:ImpactArea {impact_area: $impact_area})
+    UNWIND $rows AS row
+    MERGE (ia:ImpactArea {impact_area: row.impact_area})
     """
-    parameters = {"impact_area": impact_area_text}
-    execute_query(driver, create_provider_query, parameters)
+    tx.run(create_provider_query, rows=rows)
 
 
 # Function to create comment nodes
-def create_comments_node(driver, comments):
-    print("Creating comments node")
+def create_comments_nodes(tx, rows):
     create_provider_query = """
-    MERGE (c:Comments {comments: $comments})
+    UNWIND $rows AS row
+    MERGE (c:Comments {hash: row.comments_hash})
+    ON CREATE SET c.comments = row.comments
     """
-    parameters = {"comments": comments}
-    execute_query(driver, create_provider_query, parameters)
+    tx.run(create_provider_query, rows=rows)
 
 
 # Function to create intra-issue tree
-def create_intra_issue_tree(
-    driver,
-    code,
-    title,
-    summary,
-    issue_description,
-    steps_reproduce,
-    priority,
-    root_cause,
-    impact_area,
-    comments,
-):
-    print("Creating ticket relationships")
+def create_intra_issue_tree(tx, rows):
     create_relationships_query = """
-    MATCH (t:Ticket {code: $code, title: $title}), (s:Summary {summary: $summary})
+    UNWIND $rows AS row
+    MATCH (t:Ticket {code: row.code}), (s:Summary {hash: row.summary_hash})
     MERGE (t)-[:HAS_SUMMARY]->(s)
-    WITH t
-    MATCH (t), (id:IssueDescription {description: $description})
+    WITH t, row
+    MATCH (id:IssueDescription {hash: row.description_hash})
     MERGE (t)-[:HAS_ISSUE_DESCRIPTION]->(id)
-    WITH t
-    MATCH (t), (sr:StepReproduce {step: $step})
+    WITH t, row
+    MATCH (sr:StepReproduce {hash: row.step_hash})
     MERGE (t)-[:HAS_STEPS_TO_REPRODUCE]->(sr)
-    WITH t
-    MATCH (t), (p:Priority {priority: $priority})
+    WITH t, row
+    MATCH (p:Priority {priority: row.priority})
     MERGE (t)-[:HAS_PRIORITY]->(p)
-    WITH t
-    MATCH (t), (rc:RootCause {root_cause: $root_cause})
+    WITH t, row
+    MATCH (rc:RootCause {root_cause: row.root_cause})
     MERGE (t)-[:HAS_ROOT_CAUSE]->(rc)
-    WITH t
-    MATCH (t), (ia:ImpactArea {impact_area: $impact_area})
+    WITH t, row
+    MATCH (ia:ImpactArea {impact_area: row.impact_area})
     MERGE (t)-[:HAS_IMPACT_AREA]->(ia)
-    WITH t
-    MATCH (t), (c:Comments {comments: $comments})
+    WITH t, row
+    MATCH (c:Comments {hash: row.comments_hash})
     MERGE (t)-[:HAS_COMMENTS]->(c)
     """
-    parameters = {
-        "code": code,
-        "title": title,
-        "summary": summary,
-        "description": issue_description,
-        "step": steps_reproduce,
-        "priority": priority,
-        "root_cause": root_cause,
-        "impact_area": impact_area,
-        "comments": comments,
-    }
-    execute_query(driver, create_relationships_query, parameters)
-
+    tx.run(create_relationships_query, rows=rows)
 
-# Function to create clone from relationship
-def create_clone_from_relationship(driver, code, clone_from_code):
-    print("Creating clone from relationship")
-    with driver.session() as session:
-        session.run(
-            "CREATE CONSTRAINT IF NOT EXISTS FOR (t:Ticket) REQUIRE t.code IS UNIQUE"
-        )
 
+# Function to create clone from relationships
+def create_clone_from_relationships(tx, edges):
     create_clone_query = """
-                        MATCH (t1:Ticket {code: $code1})
-                        MATCH (t2:Ticket {code: $code2})
-                        MERGE (t1)-[:CLONE_FROM]->(t2)
-                        """
-    parameters = {"code1": code, "code2": clone_from_code}
-    execute_query(driver, create_clone_query, parameters)
-
-
-# Function to create clone to relationship
-def create_clone_to_relationship(driver, code, clone_to_code):
-    print("Creating clone to relationship")
-    with driver.session() as session:
-        session.run(
-            "CREATE CONSTRAINT IF NOT EXISTS FOR (t:Ticket) REQUIRE t.code IS UNIQUE"
-        )
+    UNWIND $edges AS edge
+    MATCH (t1:Ticket {code: edge.source})
+    MATCH (t2:Ticket {code: edge.target})
+    MERGE (t1)-[:CLONE_FROM]->(t2)
+    """
+    tx.run(create_clone_query, edges=edges)
 
+
+# Function to create clone to relationships
+def create_clone_to_relationships(tx, edges):
     create_clone_query = """
-                        MATCH (t1:Ticket {code: $code1})
-                        MATCH (t2:Ticket {code: $code2})
-                        MERGE (t1)-[:CLONE_TO]->(t2)
-                        """
-    parameters = {"code1": code, "code2": clone_to_code}
-    execute_query(driver, create_clone_query, parameters)
+    UNWIND $edges AS edge
+    MATCH (t1:Ticket {code: edge.source})
+    MATCH (t2:Ticket {code: edge.target})
+    MERGE (t1)-[:CLONE_TO]->(t2)
+    """
+    tx.run(create_clone_query, edges=edges)
 
 
-# Function to create similar to relationship
-def create_similar_to_relationship():
-    print("Creating similar to relationship")
-    driver = GraphDatabase.driver(NEO4J_URI, auth=AUTH)
+# Function to create similar to relationships
+def create_similar_to_relationships(tx, edges):
+    create_similar_query = """
+    UNWIND $edges AS edge
+    MATCH (t1:Ticket {code: edge.source})
+    MATCH (t2:Ticket {code: edge.target})
+    MERGE (t1)-[:SIMILAR_TO]->(t2)
+    MERGE (t2)-[:SIMILAR_TO]->(t1)
+    """
+    tx.run(create_similar_query, edges=edges)
+
+
+# Function to create the shared dimension nodes of one batch
+def create_dimension_nodes(tx, values):
+    create_dimension_query = """
+    UNWIND $priorities AS priority
+    MERGE (:Priority {priority: priority})
+    WITH count(*) AS ignored
+    UNWIND $root_causes AS root_cause
+    MERGE (:RootCause {root_cause: root_cause})
+    WITH count(*) AS ignored
+    UNWIND $impact_areas AS impact_area
+    MERGE (:ImpactArea {impact_area: impact_area})
+    """
+    tx.run(create_dimension_query, **values)
+
+
+# Ticket-to-ticket edges are resolved while streaming the CSV. An edge is
+# written as soon as both of its tickets are loaded; until then it waits in a
+# map keyed by the missing ticket code. Edges whose target never shows up are
+# flushed once at the end, in case the ticket was loaded by an earlier run.
+class PendingEdges:
+    EDGE_TYPES = ("clone_from", "clone_to", "similar_to")
+
+    def __init__(self):
+        self.loaded = set()
+        self.waiting = {}
+        self.ready = []
+        self.written = set()
+        # SIMILAR_TO pairs listed by unchanged tickets, keyed by the ticket they
+        # point at, and the tickets changed so far in this sync
+        self.unchanged_similar = {}
+        self.changed = set()
+
+    def add_rows(self, rows):
+        for row in rows:
+            for edge_type in self.EDGE_TYPES:
+                for target in row[edge_type]:
+                    self._add((edge_type, row["code"], target))
+
+    def _add(self, edge):
+        _, source, target = edge
+        if edge[0] == "similar_to" and target < source:
+            # SIMILAR_TO is written in both directions, so (a, b) == (b, a)
+            edge = (edge[0], target, source)
+            source, target = target, source
+
+        key = hash(edge)
+        if key in self.written:
+            return
+        for code in (source, target):
+            if code not in self.loaded:
+                self.waiting.setdefault(code, []).append(edge)
+                return
+        self.written.add(key)
+        self.ready.append(edge)
+
+    # Resetting a changed ticket deletes both directions of every SIMILAR_TO pair,
+    # including pairs only the unchanged ticket at the other end still lists, so
+    # those are queued again once both sides are known
+    def requeue_similar(self, unchanged_rows, changed_codes):
+        self.changed.update(changed_codes)
+        for code in changed_codes:
+            for source in self.unchanged_similar.pop(code, []):
+                self._add(("similar_to", source, code))
+        for row in unchanged_rows:
+            for target in row["similar_to"]:
+                if target in self.changed:
+                    self._add(("similar_to", row["code"], target))
+                else:
+                    self.unchanged_similar.setdefault(target, []).append(row["code"])
+
+    def mark_loaded(self, codes):
+        self.loaded.update(codes)
+        for code in codes:
+            for edge in self.waiting.pop(code, []):
+                self._add(edge)
+
+    def pending_count(self):
+        return sum(len(edges) for edges in self.waiting.values())
+
+    def take_ready(self):
+        ready, self.ready = self.ready, []
+        return group_edges(ready)
+
+    def take_unresolved(self):
+        unresolved = {edge for edges in self.waiting.values() for edge in edges}
+        self.waiting = {}
+        return group_edges(unresolved)
+
+
+# Function to group edge tuples into UNWIND parameters by relationship type
+def group_edges(edges):
+    grouped = {edge_type: [] for edge_type in PendingEdges.EDGE_TYPES}
+    for edge_type, source, target in edges:
+        grouped[edge_type].append({"source": source, "target": target})
+    return grouped
+
+
+# Function to write a group of ticket-to-ticket edges
+def write_ticket_edges(tx, edges):
+    if edges["clone_from"]:
+        create_clone_from_relationships(tx, edges["clone_from"])
+    if edges["clone_to"]:
+        create_clone_to_relationships(tx, edges["clone_to"])
+    if edges["similar_to"]:
+        create_similar_to_relationships(tx, edges["similar_to"])
+
+
+# Function to render the context documents of tickets from their linked sections.
+# Runs in the transaction that wrote the sections, so a document is never older
+# than the version it is stamped with.
+def build_ticket_contexts(tx, codes):
+    result = tx.run(TICKET_CONTEXT_QUERY, codes=codes)
+    contexts = [
+        {
+            "code": record["code"],
+            "version": record["version"],
+            "context": json.dumps(record["context"], ensure_ascii=False),
+        }
+        for record in result
+    ]
+    store_query = """
+    UNWIND $contexts AS row
+    MATCH (t:Ticket {code: row.code})
+    SET t.context = row.context, t.context_version = row.version
+    """
+    tx.run(store_query, contexts=contexts)
+
+
+# Function to write the ticket-owned nodes of one batch. The dimension nodes are
+# merged beforehand and only matched here, so parallel workers do not contend
+# for the same locks.
+def write_ticket_partition(tx, rows):
+    create_ticket_nodes(tx, rows)
+    create_summary_nodes(tx, rows)
+    create_issue_description_nodes(tx, rows)
+    create_step_reproduce_nodes(tx, rows)
+    create_comments_nodes(tx, rows)
+    create_intra_issue_tree(tx, rows)
+    build_ticket_contexts(tx, [row["code"] for row in rows])
+
+
+# Function to write all nodes, relationships and resolved edges of one batch
+# in a single transaction
+def write_ticket_batch(tx, rows, edges):
+    create_ticket_nodes(tx, rows)
+    create_summary_nodes(tx, rows)
+    create_issue_description_nodes(tx, rows)
+    create_step_reproduce_nodes(tx, rows)
+    create_priority_nodes(tx, rows)
+    create_root_cause_nodes(tx, rows)
+    create_impact_area_nodes(tx, rows)
+    create_comments_nodes(tx, rows)
+    create_intra_issue_tree(tx, rows)
+    build_ticket_contexts(tx, [row["code"] for row in rows])
+    write_ticket_edges(tx, edges)
+
+
+# Function to run a managed write transaction, retrying transient errors
+# (e.g. deadlocks) with exponential backoff and jitter
+def execute_write_with_retry(driver, transaction_function, *args):
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            with driver.session(database=NEO4J_DATABASE) as session:
+                return session.execute_write(transaction_function, *args)
+        except TransientError as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = min(0.1 * 2**attempt, 5.0) * (0.5 + random.random())
+            print(f"Transient error (attempt {attempt}/{MAX_RETRIES}): {e}")
+            time.sleep(delay)
+
+
+# Function to count the edges in a group
+def count_edges(edges):
+    return sum(len(group) for group in edges.values())
+
+
+# Function to flush the edges whose target never appeared in the CSV
+def flush_unresolved_edges(driver, pending_edges, batch_size=BATCH_SIZE):
+    unresolved = pending_edges.take_unresolved()
+    print(f"Flushing {count_edges(unresolved)} unresolved ticket edges")
+    for edge_type, edges in unresolved.items():
+        for i in range(0, len(edges), batch_size):
+            batch = group_edges([])
+            batch[edge_type] = edges[i : i + batch_size]
+            execute_write_with_retry(driver, write_ticket_edges, batch)
+
+
+# Function to load the whole CSV file batch by batch in a single pass
+def load_tickets(driver, csv_file_name, batch_size=BATCH_SIZE):
+    total_rows = 0
+    total_edges = 0
+    start = time.perf_counter()
+    pending_edges = PendingEdges()
+
+    with driver.session(database=NEO4J_DATABASE) as session:
+        for rows in read_batches(csv_file_name, batch_size):
+            batch_start = time.perf_counter()
+            pending_edges.add_rows(rows)
+            pending_edges.mark_loaded([row["code"] for row in rows])
+            edges = pending_edges.take_ready()
+            session.execute_write(write_ticket_batch, rows, edges)
+            batch_elapsed = time.perf_counter() - batch_start
+            total_rows += len(rows)
+            total_edges += count_edges(edges)
+            print(
+                f"Loaded batch of {len(rows)} rows in {batch_elapsed:.2f}s "
+                f"({len(rows) / batch_elapsed if batch_elapsed else 0:.1f} rows/sec, "
+                f"{pending_edges.pending_count()} edges pending)"
+            )
 
-    with driver.session() as session:
-        session.run(
-            "CREATE CONSTRAINT IF NOT EXISTS FOR (t:Ticket) REQUIRE t.code IS UNIQUE"
-        )
+    flush_unresolved_edges(driver, pending_edges, batch_size)
 
-    with open(CSV_FILE_NAME, mode="r") as file:
-        reader = csv.DictReader(file)
-        print("Reading CSV file...")
+    elapsed = time.perf_counter() - start
+    print(
+        f"Loaded {total_rows} rows and {total_edges} edges in {elapsed:.2f}s "
+        f"({total_rows / elapsed if elapsed else 0:.1f} rows/sec)"
+    )
+    return total_rows
 
-        for row in reader:
-            code = row["Code"]
-            similar_to = json.loads(row["Similar_To"])
-
-            for st in similar_to:
-                create_similar_query = """
-                        MATCH (t1:Ticket {code: $code1})
-                        MATCH (t2:Ticket {code: $code2})
-                        MERGE (t1)-[:SIMILAR_TO]->(t2)
-                        MERGE (t2)-[:SIMILAR_TO]->(t1)
-                        """
-                parameters = {"code1": code, "code2": st}
-                execute_query(driver, create_similar_query, parameters)
 
-    driver.close()
+# Function to load the CSV file with a pool of workers, one partition per task
+def load_tickets_parallel(
+    driver, csv_file_name, batch_size=BATCH_SIZE, workers=LOAD_WORKERS
+):
+    total_rows = 0
+    start = time.perf_counter()
+    pending_edges = PendingEdges()
+    dimension_values = {
+        "priorities": set(),
+        "root_causes": set(),
+        "impact_areas": set(),
+    }
 
+    def collect(done):
+        # Edges may only be written once both partitions have committed
+        codes = [code for future in done for code in future.result()]
+        pending_edges.mark_loaded(codes)
+        if len(pending_edges.ready) >= batch_size:
+            execute_write_with_retry(
+                driver, write_ticket_edges, pending_edges.take_ready()
+            )
+        return len(codes)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for rows in read_batches(csv_file_name, batch_size):
+            # Merge dimension values not seen yet before any worker matches them
+            new_values = {
+                "priorities": {row["priority"] for row in rows},
+                "root_causes": {row["root_cause"] for row in rows},
+                "impact_areas": {row["impact_area"] for row in rows},
+            }
+            for key in new_values:
+                new_values[key] = sorted(new_values[key] - dimension_values[key])
+            if any(new_values.values()):
+                execute_write_with_retry(driver, create_dimension_nodes, new_values)
+                for key in new_values:
+                    dimension_values[key].update(new_values[key])
+
+            # Keep at most two partitions per worker in memory
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                total_rows += collect(done)
+            pending_edges.add_rows(rows)
+            pending.add(executor.submit(load_partition, driver, rows))
+        done, _ = wait(pending)
+        total_rows += collect(done)
+
+    execute_write_with_retry(driver, write_ticket_edges, pending_edges.take_ready())
+    flush_unresolved_edges(driver, pending_edges, batch_size)
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Loaded {total_rows} rows with {workers} workers in {elapsed:.2f}s "
+        f"({total_rows / elapsed if elapsed else 0:.1f} rows/sec)"
+    )
+    return total_rows
+
+
+# Function run by a worker to write one partition
+def load_partition(driver, rows):
+    execute_write_with_retry(driver, write_ticket_partition, rows)
+    return [row["code"] for row in rows]
+
+
+# Function to read the stored fingerprints of a batch of tickets
+def fetch_fingerprints(tx, codes):
+    fetch_query = """
+    UNWIND $codes AS code
+    MATCH (t:Ticket {code: code})
+    RETURN t.code AS code, t {.summary_hash, .description_hash, .step_hash,
+        .comments_hash, .attributes_hash} AS fingerprint
+    """
+    result = tx.run(fetch_query, codes=codes)
+    return {record["code"]: record["fingerprint"] for record in result}
+
+
+# Function to detach changed tickets from their sections and edges. Returns the
+# element ids of the detached nodes so orphaned sections can be removed later.
+# SIMILAR_TO is written in both directions, so the incoming half of every pair goes
+# too; pairs still listed by unchanged tickets are queued again by requeue_similar.
+def reset_ticket_links(tx, codes):
+    similar_query = """
+    UNWIND $codes AS code
+    MATCH (:Ticket {code: code})<-[r:SIMILAR_TO]-(:Ticket)
+    DELETE r
+    """
+    tx.run(similar_query, codes=codes)
+    reset_query = """
+    UNWIND $codes AS code
+    MATCH (t:Ticket {code: code})-[r]->(n)
+    WHERE type(r) IN $relationships
+    DELETE r
+    RETURN collect(DISTINCT elementId(n)) AS ids
+    """
+    result = tx.run(reset_query, codes=codes, relationships=TICKET_RELATIONSHIPS)
+    return result.single()["ids"]
+
+
+# Function to delete section nodes no ticket points to anymore
+def delete_orphan_sections(tx, ids):
+    delete_query = """
+    UNWIND $ids AS id
+    MATCH (n)
+    WHERE elementId(n) = id
+        AND (n:Summary OR n:IssueDescription OR n:StepReproduce OR n:Comments)
+        AND NOT EXISTS { ()-->(n) }
+    DETACH DELETE n
+    """
+    tx.run(delete_query, ids=ids)
+
+
+# Function to write new and changed tickets of one batch. Changed tickets are
+# re-linked from scratch: unchanged sections are matched again by hash and keep
+# their embedding, changed sections become new nodes without one, so only they
+# are picked up by the next embedding run.
+def sync_ticket_batch(tx, rows, changed_codes, edges):
+    detached = reset_ticket_links(tx, changed_codes)
+    write_ticket_batch(tx, rows, edges)
+    delete_orphan_sections(tx, detached)
+
+
+# Function to delete tickets that are no longer in the CSV
+def retire_tickets(tx, codes):
+    retire_query = """
+    UNWIND $codes AS code
+    MATCH (t:Ticket {code: code})
+    OPTIONAL MATCH (t)-[:HAS_SUMMARY|HAS_ISSUE_DESCRIPTION|HAS_STEPS_TO_REPRODUCE|HAS_COMMENTS]->(n)
+    DETACH DELETE t
+    WITH DISTINCT n
+    WHERE n IS NOT NULL AND NOT EXISTS { ()-->(n) }
+    DETACH DELETE n
+    """
+    tx.run(retire_query, codes=codes)
+
+
+# Function to list the ticket codes stored in the graph
+def fetch_ticket_codes(tx):
+    result = tx.run("MATCH (t:Ticket) RETURN t.code AS code")
+    return {record["code"] for record in result}
+
+
+# Function to list the tickets whose context document is missing or out of date
+def fetch_stale_context_codes(tx):
+    result = tx.run(
+        """
+        MATCH (t:Ticket)
+        WHERE t.context IS NULL OR t.context_version IS NULL
+            OR t.context_version <> t.version
+        RETURN t.code AS code
+        """
+    )
+    return [record["code"] for record in result]
+
+
+# Function to rebuild only the context documents that are missing or out of date,
+# e.g. for tickets loaded before documents existed
+def refresh_ticket_contexts(driver, batch_size=BATCH_SIZE):
+    start = time.perf_counter()
+    with driver.session(database=NEO4J_DATABASE) as session:
+        codes = session.execute_read(fetch_stale_context_codes)
+    for i in range(0, len(codes), batch_size):
+        execute_write_with_retry(
+            driver, build_ticket_contexts, codes[i : i + batch_size]
+        )
+    elapsed = time.perf_counter() - start
+    print(f"Rebuilt {len(codes)} ticket context documents in {elapsed:.2f}s")
+    return len(codes)
+
+
+# Function to apply only the delta between the CSV file and the graph
+def sync_tickets(driver, csv_file_name, batch_size=BATCH_SIZE):
+    counts = {"new": 0, "changed": 0, "unchanged": 0, "retired": 0}
+    changed_sections = {key: 0 for key in FINGERPRINT_KEYS}
+    start = time.perf_counter()
+    pending_edges = PendingEdges()
+
+    with driver.session(database=NEO4J_DATABASE) as session:
+        for rows in read_batches(csv_file_name, batch_size):
+            codes = [row["code"] for row in rows]
+            stored = session.execute_read(fetch_fingerprints, codes)
+
+            delta_rows = []
+            changed_codes = []
+            unchanged_rows = []
+            for row in rows:
+                fingerprint = stored.get(row["code"])
+                if fingerprint is None:
+                    counts["new"] += 1
+                    delta_rows.append(row)
+                    continue
+
+                changed = [
+                    key for key in FINGERPRINT_KEYS if fingerprint[key] != row[key]
+                ]
+                if not changed:
+                    counts["unchanged"] += 1
+                    unchanged_rows.append(row)
+                    continue
+
+                counts["changed"] += 1
+                for key in changed:
+                    changed_sections[key] += 1
+                delta_rows.append(row)
+                changed_codes.append(row["code"])
+
+            # Edges of unchanged tickets are already in the graph, except the
+            # SIMILAR_TO directions a changed ticket's reset deletes
+            pending_edges.add_rows(delta_rows)
+            pending_edges.requeue_similar(unchanged_rows, changed_codes)
+            pending_edges.mark_loaded(codes)
+            edges = pending_edges.take_ready()
+            if delta_rows or count_edges(edges):
+                session.execute_write(
+                    sync_ticket_batch, delta_rows, changed_codes, edges
+                )
+
+        flush_unresolved_edges(driver, pending_edges, batch_size)
+
+        retired = sorted(
+            session.execute_read(fetch_ticket_codes) - pending_edges.loaded
+        )
+        for i in range(0, len(retired), batch_size):
+            session.execute_write(retire_tickets, retired[i : i + batch_size])
+        counts["retired"] = len(retired)
 
-# Main function to read the CSV file and populate the graph
-def main():
-    driver = GraphDatabase.driver(NEO4J_URI, auth=AUTH)
+    # Catch up on tickets loaded before context documents existed
+    refresh_ticket_contexts(driver, batch_size)
 
-    with open(CSV_FILE_NAME, mode="r") as file:
-        reader = csv.DictReader(file)
-        print("Reading CSV file...")
+    elapsed = time.perf_counter() - start
+    print(
+        f"Synced in {elapsed:.2f}s: {counts['new']} new, {counts['changed']} changed, "
+        f"{counts['unchanged']} unchanged, {counts['retired']} retired tickets"
+    )
+    print(f"Changed sections: {changed_sections}")
+    return counts
 
-        for row in reader:
-            code = row["Code"]
-            title = row["Title"]
-            summary = row["Summary"]
-            issue_description = row["Issue_Description"]
-            step_reproduce = row["Step_To_Reproduce"]
-            priority = row["Priority"]
-            root_cause = row["Root_Cause"]
-            impact_area = row["Impact_Area"]
-            comments = row["Comments"]
-            clone_from = json.loads(row["Clone_From"])
-            clone_to = json.loads(row["Clone_To"])
-            # similar_to = json.loads(row["Similar_To"])
-
-            create_ticket_node(driver, code=code, title=title)
-            create_summary_node(driver, summary=summary)
-            create_issue_description_node(
-                driver, issue_description_text=issue_description
-            )
-            create_step_reproduce_node(driver, step_reproduce_text=step_reproduce)
-            create_priority_node(driver, priority_text=priority)
-            create_root_cause_node(driver, root_cause_text=root_cause)
-            create_impact_area_node(driver, impact_area_text=impact_area)
-            create_comments_node(driver, comments=comments)
-            create_intra_issue_tree(
-                driver,
-                code=code,
-                title=title,
-                summary=summary,
-                issue_description=issue_description,
-                steps_reproduce=step_reproduce,
-                priority=priority,
-                root_cause=root_cause,
-                impact_area=impact_area,
-                comments=comments,
-            )
 
-            for cf in clone_from:
-                create_clone_from_relationship(driver, code=code, clone_from_code=cf)
+# Main function to read the CSV file and populate the graph
+def main():
+    driver = GraphDatabase.driver(NEO4J_URI, auth=AUTH)
 
-            for ct in clone_to:
-                create_clone_to_relationship(driver, code=code, clone_to_code=ct)
+    # Constraints and indexes must exist before the first MERGE
+    bootstrap_schema(driver, NEO4J_DATABASE)
+    if LOAD_MODE == "sync":
+        sync_tickets(driver, CSV_FILE_NAME, BATCH_SIZE)
+    elif LOAD_MODE == "contexts":
+        refresh_ticket_contexts(driver, BATCH_SIZE)
+    elif LOAD_WORKERS > 1:
+        load_tickets_parallel(driver, CSV_FILE_NAME, BATCH_SIZE, LOAD_WORKERS)
+    else:
+        load_tickets(driver, CSV_FILE_NAME, BATCH_SIZE)
 
     driver.close()
 
-    # Create the similar relationship at the end
-    # to make sure all node was created, because
-    # it is bi-direct connection.
-    create_similar_to_relationship()
-
     print("Graph populated successfully!")
 
 
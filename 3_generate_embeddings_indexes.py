@@ -1,10 +1,15 @@
 from dotenv import load_dotenv
 import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from neo4j import GraphDatabase
 from langchain_community.graphs import Neo4jGraph
 from langchain_community.vectorstores import Neo4jVector
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
 import google.generativeai as genai
+from kg_schema import SECTION_INDEXES, bootstrap_schema
+from embedding_cache import EMBEDDING_MODEL, build_embeddings, get_embedding_cache
 
 # Load environment variables
 load_dotenv()
@@ -17,11 +22,20 @@ NEO4J_DATABASE = os.environ["NEO4J_DATABASE"]
 GOOGLE_API_KEY = os.environ["GOOGLE_API_KEY"]
 AUTH = (NEO4J_USERNAME, NEO4J_PASSWORD)
 
+# Embedding stage settings: texts per API request, requests in flight,
+# request rate limit and retries on 429 responses
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "100"))
+EMBEDDING_CONCURRENCY = int(os.environ.get("EMBEDDING_CONCURRENCY", "8"))
+EMBEDDING_REQUESTS_PER_MINUTE = int(
+    os.environ.get("EMBEDDING_REQUESTS_PER_MINUTE", "1500")
+)
+EMBEDDING_MAX_RETRIES = int(os.environ.get("EMBEDDING_MAX_RETRIES", "6"))
+
 driver = GraphDatabase.driver(NEO4J_URI, auth=AUTH, database=NEO4J_DATABASE)
 genai.configure(api_key=GOOGLE_API_KEY)
-embedding = GoogleGenerativeAIEmbeddings(
-    google_api_key=GOOGLE_API_KEY, model="models/embedding-001"
-)
+# Shared embedding client backed by the on-disk embedding cache, so reruns
+# (or a rerun after a partial failure) do not pay for the same texts again
+embedding = build_embeddings(GOOGLE_API_KEY, EMBEDDING_MODEL)
 
 # Initialize Neo4j Graph
 kg = Neo4jGraph(
@@ -34,186 +48,192 @@ kg = Neo4jGraph(
 
 def get_gemini_embedding_768(text):
     """Fetches a 768D embedding using Google Gemini API"""
+    cache = get_embedding_cache()
+    cached = cache.get(EMBEDDING_MODEL, "retrieval_document", text)
+    if cached is not None:
+        return cached
+
     response = genai.embed_content(
-        model="models/embedding-001",  # 768D embedding model
+        model=EMBEDDING_MODEL,  # 768D embedding model
         content=text,
         task_type="retrieval_document",
     )
 
     if isinstance(response, dict) and "embedding" in response:
+        cache.put(EMBEDDING_MODEL, "retrieval_document", text, response["embedding"])
         return response["embedding"]  # Returns a 768D list
 
     print("Error:", response)
     return None
 
 
-def store_issue_summary_embeddings():
-    try:
-        vector_index = Neo4jVector.from_existing_graph(
-            GoogleGenerativeAIEmbeddings(
-                google_api_key=GOOGLE_API_KEY, model="models/embedding-001"
-            ),  # use embedding-001
-            search_type="hybrid",
-            node_label="Summary",
-            index_name="issue_summary_vector_index",
-            text_node_properties=["summary"],
-            embedding_node_property="embedding",
-        )
-        # print("Vector index created successfully.")
-    except Exception as e:
-        print(f"Error creating vector index: {e}")
-
-
-def store_issue_description_embeddings():
-    try:
-        vector_index = Neo4jVector.from_existing_graph(
-            GoogleGenerativeAIEmbeddings(
-                google_api_key=GOOGLE_API_KEY, model="models/embedding-001"
-            ),  # use embedding-001
-            search_type="hybrid",
-            node_label="IssueDescription",
-            index_name="issue_description_vector_index",
-            text_node_properties=["description"],
-            embedding_node_property="embedding",
-        )
-        # print("Vector index created successfully.")
-    except Exception as e:
-        print(f"Error creating vector index: {e}")
-
-
-def store_steps_reproduce_embeddings():
-    try:
-        vector_index = Neo4jVector.from_existing_graph(
-            GoogleGenerativeAIEmbeddings(
-                google_api_key=GOOGLE_API_KEY, model="models/embedding-001"
-            ),  # use embedding-001
-            search_type="hybrid",
-            node_label="StepReproduce",
-            index_name="step_reproduce_vector_index",
-            text_node_properties=["step"],
-            embedding_node_property="embedding",
-        )
-        # print("Vector index created successfully.")
-    except Exception as e:
-        print(f"Error creating vector index: {e}")
-
-
-def create_vector_index(node_label, index_name, text_property):
-    """Create a vector index for Neo4j."""
-    try:
-        vector_index = Neo4jVector.from_existing_graph(
-            GoogleGenerativeAIEmbeddings(
-                google_api_key=GOOGLE_API_KEY, model="models/embedding-001"
-            ),
-            search_type="hybrid",  # Requires full-text + vector index
-            node_label=node_label,
-            index_name=index_name,
-            text_node_properties=[text_property],
-            embedding_node_property="embedding",
-            # metadata_node_properties=["ticket_code"],  # No need to add metadata into index
-        )
-        print(
-            f"Vector index '{index_name}' for label '{node_label}' created successfully."
-        )
-    except Exception as e:
-        print(
-            f"Error creating vector index '{index_name}' for label '{node_label}': {e}"
-        )
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` acquisitions per `per` seconds."""
+
+    def __init__(self, rate, per=60.0):
+        self.capacity = max(1, rate)
+        self.tokens = float(self.capacity)
+        self.fill_rate = rate / per
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.fill_rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.fill_rate
+            time.sleep(wait_time)
+
+
+def is_rate_limit_error(error):
+    """Return True for 429 / quota errors from the embedding API."""
+    message = str(error)
+    return (
+        "429" in message
+        or "RESOURCE_EXHAUSTED" in message
+        or "Resource has been exhausted" in message
+    )
 
 
-def create_issue_summary_vector_index():
-    kg.query(
-        """
-        CREATE FULLTEXT INDEX summary_fulltext IF NOT EXISTS
-        FOR (s:Summary) ON EACH [s.summary];
-        """
-    )
-    kg.query(
-        """
-        CREATE VECTOR INDEX summary_embeddings IF NOT EXISTS
-        FOR (s:Summary) ON (s.embedding)
-        OPTIONS {
-        indexConfig: {
-            `vector.dimensions`: 768,
-            `vector.similarity_function`: 'cosine'
-        }
-        }
+def collect_pending_texts(session, specs=SECTION_INDEXES):
+    """Return (label, hash, text) for every section node without an embedding,
+    scanning all labels in a single query."""
+    branches = [
+        f"""
+        MATCH (n:{spec['label']})
+        WHERE n.embedding IS NULL AND n.{spec['text_property']} IS NOT NULL
+        RETURN '{spec['label']}' AS label, n.hash AS hash,
+            n.{spec['text_property']} AS text
         """
+        for spec in specs
+    ]
+    result = session.run(" UNION ALL ".join(branches))
+    return [(record["label"], record["hash"], record["text"]) for record in result]
+
+
+def embed_with_retry(texts, rate_limiter):
+    """Embed one API-sized batch, retrying 429s with jittered exponential backoff."""
+    cached = embedding.cache.get_many(embedding.model, "retrieval_document", texts)
+    if all(vector is not None for vector in cached):
+        return cached  # Served from the embedding cache, no API request
+
+    for attempt in range(1, EMBEDDING_MAX_RETRIES + 1):
+        rate_limiter.acquire()
+        try:
+            return embedding.embed_documents(texts)
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt == EMBEDDING_MAX_RETRIES:
+                raise
+            delay = min(2**attempt, 60) * random.uniform(0.5, 1.5)
+            print(f"Rate limited (attempt {attempt}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def write_embeddings(tx, label, rows):
+    """Write a batch of embeddings back to one label with a single UNWIND."""
+    tx.run(
+        f"""
+        UNWIND $rows AS row
+        MATCH (n:{label} {{hash: row.hash}})
+        SET n.embedding = row.embedding
+        """,
+        rows=rows,
     )
 
-    with driver.session() as session:
-        session.run(
-            """
-            MATCH (t:Ticket)-[:HAS_SUMMARY]->(s:Summary)
-            SET s.ticket_code = t.code
-        """
-        )  # Set metadata (ticket.code) in Summary
-
-    create_vector_index("Summary", "summary_embeddings", "summary")
 
+def timed_embed(texts, rate_limiter):
+    """Embed a batch and return the vectors with the seconds it took."""
+    start = time.perf_counter()
+    vectors = embed_with_retry(texts, rate_limiter)
+    return vectors, time.perf_counter() - start
 
-def create_issue_description_vector_index():
-    kg.query(
-        """
-        CREATE FULLTEXT INDEX issue_description_fulltext IF NOT EXISTS
-        FOR (id:IssueDescription) ON EACH [id.description];
-        """
-    )
-    kg.query(
-        """
-        CREATE VECTOR INDEX issue_description_embeddings IF NOT EXISTS
-        FOR (id:IssueDescription) ON (id.embedding)
-        OPTIONS {
-            indexConfig: {
-                `vector.dimensions`: 768,
-                `vector.similarity_function`: 'cosine'
-            }
-        }
-        """
-    )
 
-    with driver.session() as session:
-        session.run(
-            """
-            MATCH (t:Ticket)-[:HAS_ISSUE_DESCRIPTION]->(id:IssueDescription)
-            SET id.ticket_code = t.code
+def backfill_ticket_codes(session, specs=SECTION_INDEXES):
+    """Set ticket_code on section nodes loaded without it, for all labels at once."""
+    relationships = "|".join(spec["relationship"] for spec in specs)
+    session.run(
+        f"""
+        MATCH (t:Ticket)-[:{relationships}]->(n)
+        WHERE n.ticket_code IS NULL
+        SET n.ticket_code = t.code
         """
-        )  # Set metadata (ticket.code) in IssueDescription
-
-    create_vector_index(
-        "IssueDescription", "issue_description_embeddings", "description"
     )
 
 
-def create_step_reproduce_vector_index():
-    kg.query(
-        """
-        CREATE FULLTEXT INDEX step_reproduce_fulltext IF NOT EXISTS
-        FOR (sr:StepReproduce) ON EACH [sr.step];
-        """
-    )
-    kg.query(
-        """
-        CREATE VECTOR INDEX step_reproduce_embeddings IF NOT EXISTS
-        FOR (sr:StepReproduce) ON (sr.embedding)
-        OPTIONS {
-            indexConfig: {
-                `vector.dimensions`: 768,
-                `vector.similarity_function`: 'cosine'
+def build_indexes(specs=SECTION_INDEXES):
+    """Embed every pending section text of every label in the table, using one
+    embedding client and one write session. The fulltext and vector indexes are
+    created by bootstrap_schema, which is a no-op once the schema is current."""
+    stats = {
+        spec["label"]: {"texts": 0, "embed_seconds": 0.0, "write_seconds": 0.0}
+        for spec in specs
+    }
+    start = time.perf_counter()
+
+    bootstrap_schema(driver, NEO4J_DATABASE)
+    with driver.session(database=NEO4J_DATABASE) as session:
+        backfill_ticket_codes(session, specs)
+
+        pending = collect_pending_texts(session, specs)
+        print(f"Embedding {len(pending)} pending section texts...")
+
+        batches = [
+            pending[i : i + EMBEDDING_BATCH_SIZE]
+            for i in range(0, len(pending), EMBEDDING_BATCH_SIZE)
+        ]
+        rate_limiter = TokenBucket(EMBEDDING_REQUESTS_PER_MINUTE)
+        with ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY) as executor:
+            futures = {
+                executor.submit(
+                    timed_embed, [text for _, _, text in batch], rate_limiter
+                ): batch
+                for batch in batches
             }
-        }
-        """
+            for future in as_completed(futures):
+                batch = futures[future]
+                vectors, embed_seconds = future.result()
+                rows_by_label = {}
+                for (label, node_hash, _), vector in zip(batch, vectors):
+                    rows_by_label.setdefault(label, []).append(
+                        {"hash": node_hash, "embedding": vector}
+                    )
+                for label, rows in rows_by_label.items():
+                    # Attribute the batch's embedding time by its share of texts
+                    stats[label]["texts"] += len(rows)
+                    stats[label]["embed_seconds"] += (
+                        embed_seconds * len(rows) / len(batch)
+                    )
+                    write_start = time.perf_counter()
+                    session.execute_write(write_embeddings, label, rows)
+                    stats[label]["write_seconds"] += time.perf_counter() - write_start
+
+        # Wait until the vector indexes have picked up the new embeddings
+        session.run("CALL db.awaitIndexes(300)")
+
+    elapsed = time.perf_counter() - start
+    print("\nIndex build report:")
+    for spec in specs:
+        label_stats = stats[spec["label"]]
+        seconds = label_stats["embed_seconds"] + label_stats["write_seconds"]
+        print(
+            f"  {spec['label']:<17} {spec['vector_index']:<29} "
+            f"{label_stats['texts']:>7} texts  "
+            f"embed {label_stats['embed_seconds']:.2f}s  "
+            f"write {label_stats['write_seconds']:.2f}s  "
+            f"({label_stats['texts'] / seconds if seconds else 0:.1f} texts/sec)"
+        )
+    print(
+        f"  Total: {len(pending)} texts in {elapsed:.2f}s "
+        f"({len(pending) / elapsed if elapsed else 0:.1f} texts/sec)"
     )
-
-    with driver.session() as session:
-        session.run(
-            """
-            MATCH (t:Ticket)-[:HAS_STEPS_TO_REPRODUCE]->(sr:StepReproduce)
-            SET sr.ticket_code = t.code
-        """
-        )  # Set metadata (ticket.code) in StepReproduce
-
-    create_vector_index("StepReproduce", "step_reproduce_embeddings", "step")
+    return stats
 
 
 def _get_all_indexes():
@@ -231,9 +251,7 @@ def test_vector_index(index_name, node_label, text_property, query_text):
         print(f"\nTesting Vector Index: {index_name} on {node_label}")
 
         vector_index = Neo4jVector.from_existing_graph(
-            GoogleGenerativeAIEmbeddings(
-                google_api_key=GOOGLE_API_KEY, model="models/embedding-001"
-            ),
+            embedding,
             search_type="hybrid",
             node_label=node_label,
             index_name=index_name,
@@ -254,9 +272,7 @@ def test_vector_index(index_name, node_label, text_property, query_text):
 
 if __name__ == "__main__":
 
-    create_issue_summary_vector_index()
-    create_issue_description_vector_index()
-    create_step_reproduce_vector_index()
+    build_indexes()
 
     # _get_all_indexes()
     # test_vector_index(
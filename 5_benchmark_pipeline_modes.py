@@ -0,0 +1,178 @@
+# Description: This script benchmarks the staged and one-shot modes of process_query.
+# Questions are generated from the ticket CSV ("How can I fix <first summary
+# sentence>?"), so each one has a known ticket. Both modes answer the same questions
+# with the answer cache and the shared query embedding store off, after a warm-up
+# of both, in an order alternating per question, and with the in-memory query
+# embeddings cleared before every question.
+# The script reports latency, LLM calls and tokens per question, how often the
+# ticket of the question was retrieved first, and how often both modes agree on the
+# ticket and the intents.
+# Run: `python 5_benchmark_pipeline_modes.py [questions]`
+
+import os
+import sys
+import csv
+import time
+import random
+from typing import Dict, List
+import numpy as np
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Every question must reach the pipeline, not the cache of an earlier run, and
+# query embeddings must not be shared through the on-disk store between the modes
+os.environ["ANSWER_CACHE"] = "0"
+os.environ["QUERY_CACHE_DISK"] = "0"
+
+import pipeline
+from cypher_templates import resolve_intents
+from context_packer import split_sentences
+
+BENCHMARK_QUESTIONS = int(os.environ.get("BENCHMARK_QUESTIONS", "20"))
+BENCHMARK_SEED = int(os.environ.get("BENCHMARK_SEED", "0"))
+BENCHMARK_WARMUP = int(os.environ.get("BENCHMARK_WARMUP", "2"))
+MODES = ["staged", "one_shot"]
+
+
+class LLMUsageCounter(BaseCallbackHandler):
+    """Counts the LLM calls and the tokens they used."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.calls += 1
+
+    def on_llm_end(self, response, **kwargs):
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(
+                    getattr(generation, "message", None), "usage_metadata", None
+                )
+                if usage:
+                    self.input_tokens += usage.get("input_tokens", 0)
+                    self.output_tokens += usage.get("output_tokens", 0)
+
+
+# Function to build the benchmark questions from the ticket CSV. Titles are not
+# indexed and unrelated to the ticket text, so the question is taken from the
+# first sentence of the summary, which is embedded and fulltext-indexed.
+def load_questions(csv_file_name, count, seed=BENCHMARK_SEED) -> List[Dict]:
+    csv.field_size_limit(sys.maxsize)
+    with open(csv_file_name, mode="r", newline="", encoding="utf-8") as file:
+        rows = list(csv.DictReader(file))
+    random.Random(seed).shuffle(rows)
+    questions = []
+    for row in rows[:count]:
+        sentence = split_sentences(row["Summary"])[0].rstrip(".!? ")
+        questions.append(
+            {"question": f"How can I fix {sentence}?", "ticket_id": row["Code"]}
+        )
+    return questions
+
+
+# Function to answer one question in one mode from a cold query embedding tier
+def run_question(mode, question, counter) -> Dict:
+    pipeline.get_retriever().embeddings.query_cache.clear()
+    counter.reset()
+    start = time.perf_counter()
+    response = pipeline.process_query(question, mode=mode)
+    return {
+        "response": response,
+        "latency_ms": (time.perf_counter() - start) * 1000,
+        "llm_calls": counter.calls,
+        "input_tokens": counter.input_tokens,
+        "output_tokens": counter.output_tokens,
+    }
+
+
+# Function to run every question through both modes, alternating which mode
+# goes first so neither always finds the other's embeddings already cached
+def run_modes(questions, counter) -> Dict:
+    runs = {mode: [] for mode in MODES}
+    for i, item in enumerate(questions):
+        order = MODES if i % 2 == 0 else MODES[::-1]
+        for mode in order:
+            runs[mode].append(run_question(mode, item["question"], counter))
+
+    report = {}
+    for mode, mode_runs in runs.items():
+        latencies = np.asarray([run["latency_ms"] for run in mode_runs])
+        report[mode] = {
+            "results": [run["response"] for run in mode_runs],
+            "mean_ms": float(latencies.mean()),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "llm_calls": float(np.mean([run["llm_calls"] for run in mode_runs])),
+            "input_tokens": float(np.mean([run["input_tokens"] for run in mode_runs])),
+            "output_tokens": float(
+                np.mean([run["output_tokens"] for run in mode_runs])
+            ),
+            "hit_at_1": float(
+                np.mean(
+                    [
+                        run["response"]["ticket_id"] == item["ticket_id"]
+                        for run, item in zip(mode_runs, questions)
+                    ]
+                )
+            ),
+        }
+    return report
+
+
+# Function to print the comparison of the modes
+def print_report(report, questions):
+    print(f"\nBenchmark of {len(questions)} questions")
+    print(
+        f"{'mode':<10} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'LLM calls':>10} "
+        f"{'in tok':>8} {'out tok':>8} {'hit@1':>6}"
+    )
+    for mode in MODES:
+        stats = report[mode]
+        print(
+            f"{mode:<10} {stats['mean_ms']:>9.0f} {stats['p50_ms']:>9.0f} "
+            f"{stats['p95_ms']:>9.0f} {stats['llm_calls']:>10.2f} "
+            f"{stats['input_tokens']:>8.0f} {stats['output_tokens']:>8.0f} "
+            f"{stats['hit_at_1']:>6.0%}"
+        )
+
+    pairs = list(zip(report["staged"]["results"], report["one_shot"]["results"]))
+    same_ticket = sum(a["ticket_id"] == b["ticket_id"] for a, b in pairs)
+    same_intents = sum(
+        set(resolve_intents(a["intents"])) == set(resolve_intents(b["intents"]))
+        for a, b in pairs
+    )
+    print(f"Same top ticket in both modes: {same_ticket / len(pairs):.0%}")
+    print(f"Same resolved intents in both modes: {same_intents / len(pairs):.0%}")
+
+
+# Main function to benchmark both modes on the same questions
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else BENCHMARK_QUESTIONS
+    questions = load_questions(os.environ["CSV_FILE_NAME"], count + BENCHMARK_WARMUP)
+    warmup, questions = questions[:BENCHMARK_WARMUP], questions[BENCHMARK_WARMUP:]
+
+    counter = LLMUsageCounter()
+    pipeline.llm.callbacks = [counter]
+
+    # Attach the indexes, open the connections and load the tokenizer in both
+    # modes before timing anything; the warm-up questions are not reported
+    pipeline.get_retriever().warm_up()
+    for item in warmup:
+        for mode in MODES:
+            run_question(mode, item["question"], counter)
+
+    print(f"Running {len(questions)} questions in {' and '.join(MODES)} modes...")
+    report = run_modes(questions, counter)
+    print_report(report, questions)
+
+    pipeline.get_retriever().close()
+
+
+# Run the main function
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+# Description: Semantic response cache for process_query.
+# Answered questions are stored in a SQLite database with their unit-length question
+# embedding, the pipeline mode that answered them, the ticket they were answered from
+# and the content fingerprint of every ticket in their subgraph. A new question in the
+# same mode whose embedding is within ANSWER_CACHE_THRESHOLD cosine similarity of a
+# stored one reuses its response, unless one of those tickets has changed since.
+# Fingerprints are compared rather than t.version, which restarts at 1 when the graph
+# is wiped and reloaded. SQLite in WAL mode lets every worker process share the cache.
+
+from dotenv import load_dotenv
+import os
+import json
+import time
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+from sqlite_store import SQLiteStore
+
+load_dotenv()
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE", "1") == "1"
+ANSWER_CACHE_PATH = os.environ.get(
+    "ANSWER_CACHE_PATH",
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), ".answer_cache", "answers.sqlite3"
+    ),
+)
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.97"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "86400"))
+
+
+class AnswerCache(SQLiteStore):
+    """Size-bounded semantic cache of responses, evicting the least recently hit."""
+
+    table = "answers"
+
+    def __init__(
+        self,
+        path: str = ANSWER_CACHE_PATH,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS,
+    ):
+        super().__init__(path, max_entries, ttl_seconds)
+        self.threshold = threshold
+        # In-memory copy of the stored embeddings, reloaded when another
+        # process has committed a change or this one has written
+        self._data_version = None
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._modes = np.zeros(0, dtype=object)
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+        with self._connection as connection:
+            columns = {
+                row[1]
+                for row in connection.execute("PRAGMA table_info(answers)").fetchall()
+            }
+            if columns and not {"mode", "ticket_fingerprints"} <= columns:
+                # Entries of an older schema cannot be validated; drop them
+                connection.execute("DROP TABLE answers")
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS answers (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    question TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    mode TEXT NOT NULL,
+                    ticket_id TEXT NOT NULL,
+                    ticket_fingerprints TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_hit_at REAL NOT NULL
+                )
+                """
+            )
+            self._create_last_hit_index(connection)
+
+    def _refresh(self):
+        data_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return
+        rows = self._connection.execute(
+            "SELECT id, mode, embedding FROM answers WHERE created_at > ?",
+            (time.time() - self.ttl_seconds,),
+        ).fetchall()
+        self._ids = np.asarray([row[0] for row in rows], dtype=np.int64)
+        self._modes = np.asarray([row[1] for row in rows], dtype=object)
+        self._matrix = (
+            np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+            if rows
+            else np.zeros((0, 0), dtype=np.float32)
+        )
+        self._data_version = data_version
+
+    def find(self, question_vector: List[float], mode: str) -> Optional[Tuple]:
+        """Return (entry_id, ticket_fingerprints, response) of the most similar
+        earlier question answered in the same mode above the threshold, or None."""
+        query = np.asarray(question_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        with self._lock:
+            self._refresh()
+            if not len(self._ids) or self._matrix.shape[1] != len(query):
+                self.misses += 1
+                return None
+            # Answers of the other pipeline mode never match
+            similarities = np.where(self._modes == mode, self._matrix @ query, -1.0)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            entry_id = int(self._ids[best])
+            row = self._connection.execute(
+                """
+                SELECT ticket_fingerprints, response FROM answers
+                WHERE id = ? AND created_at > ?
+                """,
+                (entry_id, time.time() - self.ttl_seconds),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            return entry_id, json.loads(row[0]), row[1]
+
+    def resolve(
+        self, entry: Tuple, current_fingerprints: Dict[str, Optional[str]]
+    ) -> Optional[Dict]:
+        """Return the response of an entry from find, unless one of its tickets has
+        a different fingerprint now, in which case the entry is dropped."""
+        entry_id, ticket_fingerprints, response = entry
+        if any(
+            current_fingerprints.get(ticket_id) != fingerprint
+            for ticket_id, fingerprint in ticket_fingerprints.items()
+        ):
+            # A ticket changed in the graph since this answer was generated
+            with self._lock, self._connection as connection:
+                connection.execute("DELETE FROM answers WHERE id = ?", (entry_id,))
+                self._data_version = None
+                self.stale += 1
+                self.misses += 1
+            return None
+
+        with self._lock, self._connection as connection:
+            connection.execute(
+                "UPDATE answers SET last_hit_at = ? WHERE id = ?",
+                (time.time(), entry_id),
+            )
+            self.hits += 1
+        return json.loads(response)
+
+    def lookup(
+        self,
+        question_vector: List[float],
+        mode: str,
+        ticket_fingerprints: Callable[[List[str]], Dict[str, Optional[str]]],
+    ) -> Optional[Dict]:
+        """Return the cached response of the most similar earlier question answered
+        in the same mode, if it is above the threshold and its tickets still have
+        the content it was answered from."""
+        entry = self.find(question_vector, mode)
+        if entry is None:
+            return None
+        # Checked outside the lock: it is a round trip to the graph
+        return self.resolve(entry, ticket_fingerprints(list(entry[1])))
+
+    def store(
+        self,
+        question: str,
+        question_vector: List[float],
+        mode: str,
+        ticket_id: str,
+        ticket_fingerprints: Dict[str, Optional[str]],
+        response: Dict,
+    ):
+        """Add a response, then evict expired and least recently hit entries."""
+        vector = np.asarray(question_vector, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1)
+        now = time.time()
+        with self._lock, self._connection as connection:
+            connection.execute(
+                """
+                INSERT INTO answers (question, embedding, mode, ticket_id,
+                    ticket_fingerprints, response, created_at, last_hit_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    question,
+                    vector.tobytes(),
+                    mode,
+                    ticket_id,
+                    json.dumps(ticket_fingerprints),
+                    json.dumps(response),
+                    now,
+                    now,
+                ),
+            )
+            self._evict(connection, now)
+            self._data_version = None
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self._ids),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+        }
+
+
+_answer_cache = None
+_answer_cache_pid = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> Optional[AnswerCache]:
+    """Return the process-wide answer cache, or None when ANSWER_CACHE=0."""
+    global _answer_cache, _answer_cache_pid
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    with _answer_cache_lock:
+        # A forked worker opens its own SQLite connection
+        if _answer_cache is None or _answer_cache_pid != os.getpid():
+            _answer_cache = AnswerCache()
+            _answer_cache_pid = os.getpid()
+        return _answer_cache
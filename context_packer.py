@@ -0,0 +1,186 @@
+# Description: Token-budgeted context packing for the answer prompt.
+# The subgraph fields are split into sentences, sentences already seen in another
+# section or ticket are dropped, and the rest are ranked by cosine similarity to the
+# query embedding. The best ones are kept until CONTEXT_TOKEN_BUDGET tokens (counted
+# locally with tiktoken) are used, then rendered in their original order. The short
+# fields (priority, root cause, impact area, related tickets, links) of the top ticket
+# are always kept first; those of related tickets compete with the sentences.
+
+from dotenv import load_dotenv
+import os
+import re
+import functools
+from typing import Dict, List, Optional
+import numpy as np
+import tiktoken
+from langchain_core.embeddings import Embeddings
+from cypher_templates import CATEGORY_FIELDS, LIST_FIELDS, render_context
+
+load_dotenv()
+
+# Token budget of the rendered context, 0 for no packing
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "600"))
+CONTEXT_TOKENIZER = os.environ.get("CONTEXT_TOKENIZER", "cl100k_base")
+
+# Sentence ends, except the "1." "2." numbering of steps to reproduce
+SENTENCE_END = re.compile(r"(?<![0-9]\.)(?<=[.!?])\s+")
+# Fields kept whole rather than split into sentences
+SHORT_FIELDS = CATEGORY_FIELDS | LIST_FIELDS | {"title", "links", "error"}
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(name: str = CONTEXT_TOKENIZER):
+    """Load the tokenizer once; None when its BPE file cannot be loaded (offline
+    without TIKTOKEN_CACHE_DIR), in which case tokens are estimated."""
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        print(f"Error loading tokenizer {name}, estimating token counts: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        # About four characters per token for English text
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text))
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence for sentence in SENTENCE_END.split(text.strip()) if sentence]
+
+
+def sentence_key(sentence: str) -> str:
+    """Key under which repeated sentences are considered the same."""
+    return " ".join(re.findall(r"\w+", sentence.casefold()))
+
+
+def collect_fields(subgraph_data: Dict, heading: Optional[str] = None) -> List[Dict]:
+    """Flatten subgraph_data into fields, each under its ticket heading (None for
+    the top ticket). Only the top ticket's short fields are pinned."""
+    fields = []
+    related = []
+    for field, value in subgraph_data.items():
+        if field == "related_tickets":
+            for ticket in value:
+                kind = "Other candidate" if ticket["candidate"] else "Linked ticket"
+                details = {
+                    name: item
+                    for name, item in ticket.items()
+                    if name not in ("ticket_id", "candidate")
+                }
+                related.extend(
+                    collect_fields(details, f"{kind} {ticket['ticket_id']}:")
+                )
+            continue
+        if field == "links":
+            value = [
+                f"{link['source']} {link['type']} {link['target']}" for link in value
+            ]
+        if isinstance(value, list):
+            value = "; ".join(value) if value else "none"
+        short = field in SHORT_FIELDS
+        fields.append(
+            {
+                "heading": heading,
+                "label": f"{field.replace('_', ' ').capitalize()}: ",
+                "sentences": [value] if short else split_sentences(str(value)),
+                "short": short,
+                "pinned": short and heading is None,
+            }
+        )
+    # The top ticket's fields come first, so a heading is never left open for them
+    return fields + related
+
+
+def rank_sentences(query: str, candidates: List[Dict], embeddings: Embeddings):
+    """Set the cosine similarity of each candidate to the query as its score."""
+    query_vector = np.asarray(embeddings.embed_query(query))
+    vectors = np.asarray(embeddings.embed_documents([c["text"] for c in candidates]))
+    norms = np.linalg.norm(vectors, axis=1) * (np.linalg.norm(query_vector) or 1)
+    similarities = vectors @ query_vector / np.where(norms, norms, 1)
+    for candidate, similarity in zip(candidates, similarities):
+        candidate["score"] = float(similarity)
+
+
+def pack_context(
+    query: str,
+    subgraph_data: Dict,
+    embeddings: Optional[Embeddings] = None,
+    budget: int = CONTEXT_TOKEN_BUDGET,
+) -> str:
+    """Render subgraph_data as the context of the answer prompt, within budget tokens."""
+    if not budget:
+        return render_context(subgraph_data)
+    fields = collect_fields(subgraph_data)
+
+    # One candidate per distinct sentence, in document order; short values such
+    # as a priority are kept for every ticket even when they are the same
+    candidates = []
+    seen = set()
+    for index, field in enumerate(fields):
+        for sentence in field["sentences"]:
+            key = sentence_key(sentence)
+            if not key or (key in seen and not field["short"]):
+                continue
+            seen.add(key)
+            candidates.append(
+                {
+                    "field": index,
+                    "text": sentence,
+                    "tokens": count_tokens(sentence) + 1,
+                    "pinned": field["pinned"],
+                    "score": 0.0,
+                }
+            )
+
+    # The top ticket's short fields first, then the most relevant sentences and
+    # short fields of related tickets; without embeddings they keep document order
+    ranked = [candidate for candidate in candidates if not candidate["pinned"]]
+    if embeddings is not None and ranked:
+        try:
+            rank_sentences(query, ranked, embeddings)
+        except Exception as e:
+            print(f"Error ranking context sentences: {e}")
+    order = sorted(
+        range(len(candidates)),
+        key=lambda i: (not candidates[i]["pinned"], -candidates[i]["score"], i),
+    )
+
+    # Fill the budget; a field's label and ticket heading are paid for by the
+    # first sentence kept under them
+    used = 0
+    kept = set()
+    opened = set()
+    for i in order:
+        candidate = candidates[i]
+        field = fields[candidate["field"]]
+        cost = candidate["tokens"]
+        if candidate["field"] not in opened:
+            cost += count_tokens(field["label"])
+        if field["heading"] and field["heading"] not in opened:
+            cost += count_tokens(field["heading"]) + 1
+        if used + cost > budget:
+            continue
+        used += cost
+        kept.add(i)
+        opened.update((candidate["field"], field["heading"]))
+
+    lines = []
+    heading = None
+    for index, field in enumerate(fields):
+        sentences = [
+            candidate["text"]
+            for i, candidate in enumerate(candidates)
+            if i in kept and candidate["field"] == index
+        ]
+        if not sentences:
+            continue
+        if field["heading"] != heading:
+            heading = field["heading"]
+            lines.append(heading)
+        lines.append(field["label"] + " ".join(sentences))
+    context = "\n".join(lines)
+    print(f"*** Packed context: {count_tokens(context)} tokens (budget {budget})")
+    return context
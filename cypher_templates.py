@@ -0,0 +1,261 @@
+# Description: Per-intent Cypher templates for subgraph retrieval.
+# Every intent names the ticket fields it needs, and every field is a single Cypher
+# expression over the matched ticket `t`. The intents detected for a question are
+# combined into one query returning the union of their fields, so supporting a new
+# intent adds columns to that query, not round trips. The neighbourhood query does the
+# same for several candidate tickets at once, plus the tickets linked to them by
+# CLONE_FROM, CLONE_TO and SIMILAR_TO within a hop budget.
+# The section fields are read from the context document 2_create_kg.py materialises on
+# each Ticket (t.context, stamped with t.context_version), and only traversed when the
+# document is missing or older than the ticket.
+
+from dotenv import load_dotenv
+import os
+import json
+from typing import Dict, List
+
+load_dotenv()
+
+# Related tickets returned per relationship type
+RELATED_TICKET_LIMIT = 5
+
+# Candidate tickets expanded per question, hops followed from each of them and the
+# number of linked tickets kept per candidate (closest first)
+SUBGRAPH_TICKETS = int(os.environ.get("SUBGRAPH_TICKETS", "3"))
+SUBGRAPH_HOPS = int(os.environ.get("SUBGRAPH_HOPS", "1"))
+SUBGRAPH_FAN_OUT = int(os.environ.get("SUBGRAPH_FAN_OUT", "5"))
+MAX_SUBGRAPH_HOPS = 3
+
+# Pattern comprehension bodies of the fields stored in nodes linked to the ticket
+SECTION_PATTERNS = {
+    "summary": "(t)-[:HAS_SUMMARY]->(s) | s.summary",
+    "description": "(t)-[:HAS_ISSUE_DESCRIPTION]->(d) | d.description",
+    "steps_to_reproduce": "(t)-[:HAS_STEPS_TO_REPRODUCE]->(s) | s.step",
+    "priority": "(t)-[:HAS_PRIORITY]->(p) | p.priority",
+    "root_cause": "(t)-[:HAS_ROOT_CAUSE]->(rc) | rc.root_cause",
+    "impact_area": "(t)-[:HAS_IMPACT_AREA]->(ia) | ia.impact_area",
+    "comments": "(t)-[:HAS_COMMENTS]->(c) | c.comments",
+}
+
+# Reads the section fields of tickets as one map, rendered into t.context at ingest
+TICKET_CONTEXT_QUERY = (
+    """
+    UNWIND $codes AS code
+    MATCH (t:Ticket {code: code})
+    RETURN t.code AS code, t.version AS version, {"""
+    + ", ".join(f"{field}: [{pattern}]" for field, pattern in SECTION_PATTERNS.items())
+    + """} AS context
+    """
+)
+# True when the ticket's context document is up to date
+CONTEXT_IS_FRESH = "t.context_version = t.version"
+
+FIELD_EXPRESSIONS = {
+    "title": "t.title",
+    **{field: f"head([{pattern}])" for field, pattern in SECTION_PATTERNS.items()},
+    "similar_tickets": (
+        "[(t)-[:SIMILAR_TO]->(o:Ticket) | o.code + ': ' + coalesce(o.title, '')]"
+        f"[..{RELATED_TICKET_LIMIT}]"
+    ),
+    "cloned_tickets": (
+        "[(t)-[:CLONE_FROM|CLONE_TO]-(o:Ticket) | o.code + ': ' + coalesce(o.title, '')]"
+        f"[..{RELATED_TICKET_LIMIT}]"
+    ),
+}
+LIST_FIELDS = {"similar_tickets", "cloned_tickets"}
+# Short categorical values, repeated as they are instead of referencing another ticket
+CATEGORY_FIELDS = {"priority", "root_cause", "impact_area"}
+
+# Fields each intent needs, in the order they are given to the answer prompt
+INTENT_TEMPLATES = {
+    "reproduce issue": ["description", "steps_to_reproduce"],
+    "fix solution": ["description", "root_cause", "comments", "similar_tickets"],
+    "root cause": ["description", "root_cause", "impact_area"],
+    "impact": ["description", "impact_area", "priority"],
+    "priority": ["priority", "impact_area"],
+    "related tickets": ["summary", "similar_tickets", "cloned_tickets"],
+}
+DEFAULT_INTENT = "reproduce issue"
+
+# Keywords mapping the free-form intents of the extractors to a template
+INTENT_KEYWORDS = [
+    ("reproduce issue", ("reproduc", "replicat", "step")),
+    ("fix solution", ("fix", "solution", "solv", "resolv", "workaround", "repair")),
+    ("root cause", ("cause", "why", "reason", "root")),
+    ("impact", ("impact", "affect", "scope")),
+    ("priority", ("priority", "severity", "urgen")),
+    ("related tickets", ("similar", "related", "clone", "duplicate")),
+]
+
+
+def resolve_intents(intents: List[str]) -> List[str]:
+    """Map detected intents to template names, falling back to DEFAULT_INTENT."""
+    resolved = []
+    for intent in intents:
+        lowered = intent.lower()
+        if lowered in INTENT_TEMPLATES:
+            resolved.append(lowered)
+            continue
+        resolved.extend(
+            name
+            for name, keywords in INTENT_KEYWORDS
+            if any(keyword in lowered for keyword in keywords)
+        )
+    return list(dict.fromkeys(resolved)) or [DEFAULT_INTENT]
+
+
+def intent_fields(intents: List[str]) -> List[str]:
+    """Union of the fields of every resolved intent, without duplicates."""
+    return list(
+        dict.fromkeys(
+            field
+            for intent in resolve_intents(intents)
+            for field in INTENT_TEMPLATES[intent]
+        )
+    )
+
+
+def build_neighbourhood_query(intents: List[str], hops: int = SUBGRAPH_HOPS) -> str:
+    """Build the single query expanding $ids up to `hops` links away (at most
+    $fan_out linked tickets per candidate) with every field the intents need.
+
+    Section fields come back as lists so tickets with several description or
+    step nodes keep all of them, and are only traversed for tickets without a fresh
+    context document. Rows are ordered candidates first, in $ids order.
+    """
+    hops = max(0, min(int(hops), MAX_SUBGRAPH_HOPS))
+    columns = ",\n    ".join(
+        (
+            f"CASE WHEN {CONTEXT_IS_FRESH} THEN null "
+            f"ELSE [{SECTION_PATTERNS[field]}] END AS {field}"
+            if field in SECTION_PATTERNS
+            else f"{FIELD_EXPRESSIONS[field]} AS {field}"
+        )
+        for field in intent_fields(intents)
+    )
+    # One hop at a time from the tickets reached by the previous one, keeping at
+    # most $fan_out new tickets per hop, so the work is bounded by the fan-out
+    # instead of by the number of paths (SIMILAR_TO alone doubles them)
+    expand = "WITH seed, [seed] AS visited, [seed] AS frontier"
+    for _ in range(hops):
+        expand += """
+    CALL {
+        WITH visited, frontier
+        UNWIND frontier AS f
+        MATCH (f)-[:CLONE_FROM|CLONE_TO|SIMILAR_TO]-(n:Ticket)
+        WHERE NOT n IN visited
+        WITH DISTINCT n
+        ORDER BY n.code
+        LIMIT $fan_out
+        RETURN collect(n) AS hop
+    }
+    WITH seed, visited + hop AS visited, hop AS frontier"""
+    expand += "\n    WITH seed, visited[1..$fan_out + 1] AS neighbours"
+    return f"""
+    UNWIND $ids AS id
+    MATCH (seed:Ticket {{code: id}})
+    {expand}
+    WITH collect(seed) AS seeds, collect(neighbours) AS neighbour_lists
+    WITH seeds, reduce(acc = [], ns IN neighbour_lists |
+        acc + [n IN ns WHERE NOT n IN acc AND NOT n IN seeds]) AS neighbours
+    WITH seeds, seeds + neighbours AS tickets
+    UNWIND range(0, size(tickets) - 1) AS position
+    WITH tickets, tickets[position] AS t, position < size(seeds) AS seed, position
+    RETURN t.code AS ticket_id, t.fingerprint AS fingerprint, seed,
+    [(t)-[r:CLONE_FROM|CLONE_TO|SIMILAR_TO]->(o:Ticket) WHERE o IN tickets |
+        {{type: type(r), target: o.code}}] AS links,
+    CASE WHEN {CONTEXT_IS_FRESH} THEN t.context END AS context,
+    {columns}
+    ORDER BY position
+    """
+
+
+def neighbourhood_fingerprints(result: List[Dict]) -> Dict[str, str]:
+    """Content fingerprint of every ticket in the rows of the neighbourhood query,
+    read in the same snapshot as their fields."""
+    return {row["ticket_id"]: row["fingerprint"] for row in result}
+
+
+def format_neighbourhood(ticket_ids: List[str], result: List[Dict]) -> Dict:
+    """Shape the rows of the neighbourhood query into subgraph_data.
+
+    The first candidate found is flattened into the fields a single-ticket
+    subgraph has; the other tickets go to "related_tickets" and the links between
+    all of them to "links". Section lists are deduplicated, and a text already
+    shown for an earlier ticket is replaced by a reference to that ticket.
+    """
+    if not result:
+        return {"error": "No subgraph data found for tickets " + ", ".join(ticket_ids)}
+
+    seen_texts = {}
+    links = {}
+    tickets = []
+    for row in result:
+        if row["context"] is not None:
+            context = json.loads(row["context"])
+            row = {
+                field: context.get(field, []) if field in SECTION_PATTERNS else value
+                for field, value in row.items()
+            }
+        ticket = {}
+        for field, value in row.items():
+            if field in ("ticket_id", "fingerprint", "seed", "links", "context"):
+                continue
+            if field in SECTION_PATTERNS:
+                values = []
+                for text in dict.fromkeys(value):
+                    if text in seen_texts and field not in CATEGORY_FIELDS:
+                        values.append(f"(same as {seen_texts[text]})")
+                    else:
+                        seen_texts.setdefault(text, row["ticket_id"])
+                        values.append(text)
+                value = "\n".join(values) or None
+            if value is None:
+                value = (
+                    []
+                    if field in LIST_FIELDS
+                    else f"No {field.replace('_', ' ')} found"
+                )
+            ticket[field] = value
+        for link in row["links"]:
+            # SIMILAR_TO is written in both directions; keep one of them
+            pair = (link["type"], row["ticket_id"], link["target"])
+            if link["type"] == "SIMILAR_TO":
+                pair = ("SIMILAR_TO", *sorted(pair[1:]))
+            links[pair] = {"source": pair[1], "type": pair[0], "target": pair[2]}
+        tickets.append((row["ticket_id"], row["seed"], ticket))
+
+    _, _, primary = tickets[0]
+    subgraph = dict(primary)
+    subgraph["related_tickets"] = [
+        {"ticket_id": code, "candidate": seed, **fields}
+        for code, seed, fields in tickets[1:]
+    ]
+    subgraph["links"] = list(links.values())
+    return subgraph
+
+
+def render_context(subgraph_data: Dict) -> str:
+    """Render subgraph_data as the context lines of the answer prompt."""
+    lines = []
+    for field, value in subgraph_data.items():
+        if field == "related_tickets":
+            for ticket in value:
+                kind = "Other candidate" if ticket["candidate"] else "Linked ticket"
+                details = render_context(
+                    {
+                        name: item
+                        for name, item in ticket.items()
+                        if name not in ("ticket_id", "candidate")
+                    }
+                )
+                lines.append(f"{kind} {ticket['ticket_id']}:\n{details}")
+            continue
+        if field == "links":
+            value = [
+                f"{link['source']} {link['type']} {link['target']}" for link in value
+            ]
+        if isinstance(value, list):
+            value = "; ".join(value) if value else "none"
+        lines.append(f"{field.replace('_', ' ').capitalize()}: {value}")
+    return "\n".join(lines)
@@ -0,0 +1,439 @@
+# Description: Persistent on-disk cache for text embeddings.
+# Vectors are keyed by (model name, task_type, sha256(text)) and stored as rows of an
+# append-only float32 matrix that is read through a memory map, next to a small
+# tab-separated offset index mapping each key to its row. Query embeddings are kept
+# in a bounded in-memory LRU tier with a TTL, keyed on the normalized query text, and
+# shared between workers through a size-bounded, expiring SQLite store instead: user
+# questions never repeat often enough to earn a row in the append-only matrix.
+
+from dotenv import load_dotenv
+import os
+import fcntl
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from sqlite_store import SQLiteStore
+
+load_dotenv()
+
+EMBEDDING_MODEL = "models/embedding-001"
+EMBEDDING_DIMENSIONS = 768
+EMBEDDING_CACHE_DIR = os.environ.get(
+    "EMBEDDING_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".embedding_cache"),
+)
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "google")
+
+# In-memory query embedding tier, and whether its misses go through the shared
+# on-disk store (so workers reuse each other's query embeddings) or to the API
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "4096"))
+QUERY_CACHE_TTL_SECONDS = float(os.environ.get("QUERY_CACHE_TTL_SECONDS", "3600"))
+QUERY_CACHE_DISK = os.environ.get("QUERY_CACHE_DISK", "1") == "1"
+QUERY_CACHE_DISK_MAX_ENTRIES = int(
+    os.environ.get("QUERY_CACHE_DISK_MAX_ENTRIES", "100000")
+)
+QUERY_CACHE_DISK_TTL_SECONDS = float(
+    os.environ.get("QUERY_CACHE_DISK_TTL_SECONDS", "86400")
+)
+
+
+def text_sha256(text: str) -> str:
+    """Return the hex sha256 of a text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def normalize_query(text: str) -> str:
+    """Collapse whitespace and case so near-identical questions share a cache key."""
+    return " ".join(text.split()).casefold()
+
+
+class LRUCache:
+    """Thread-safe, size-bounded LRU cache whose entries expire after a TTL."""
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class EmbeddingCache:
+    """Append-only embedding store: vectors.f32 holds the rows, index.tsv the keys."""
+
+    def __init__(
+        self,
+        directory: str = EMBEDDING_CACHE_DIR,
+        dimensions: int = EMBEDDING_DIMENSIONS,
+    ):
+        self.directory = directory
+        self.dimensions = dimensions
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.index_path = os.path.join(directory, "index.tsv")
+        self.lock_path = os.path.join(directory, "cache.lock")
+        self.rows: Dict[str, int] = {}
+        self.matrix = None
+        self._index_offset = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._load_index()
+
+    @staticmethod
+    def key(model: str, task_type: str, text: str) -> str:
+        return f"{model}\t{task_type}\t{text_sha256(text)}"
+
+    def _row_count(self) -> int:
+        if not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (4 * self.dimensions)
+
+    def _load_index(self):
+        """Read index lines appended since the last load (by any process)."""
+        if not os.path.exists(self.index_path):
+            return
+        row_count = self._row_count()
+        with open(self.index_path, mode="r", encoding="utf-8") as file:
+            file.seek(self._index_offset)
+            for line in file:
+                if not line.endswith("\n"):
+                    break  # Partially written line, picked up on the next load
+                model, task_type, digest, row = line.rstrip("\n").split("\t")
+                # Ignore rows whose vector was never fully written
+                if int(row) < row_count:
+                    self.rows[f"{model}\t{task_type}\t{digest}"] = int(row)
+                self._index_offset += len(line.encode("utf-8"))
+        self._open_matrix(row_count)
+
+    def _open_matrix(self, row_count: int):
+        if row_count == 0:
+            self.matrix = None
+        elif self.matrix is None or self.matrix.shape[0] != row_count:
+            self.matrix = np.memmap(
+                self.vectors_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(row_count, self.dimensions),
+            )
+
+    def get_many(
+        self, model: str, task_type: str, texts: List[str]
+    ) -> List[Optional[List[float]]]:
+        """Return the cached vector of every text, or None where it is missing."""
+        keys = [self.key(model, task_type, text) for text in texts]
+        with self._lock:
+            if any(key not in self.rows for key in keys):
+                self._load_index()
+            rows = [self.rows.get(key) for key in keys]
+            return [None if row is None else self.matrix[row].tolist() for row in rows]
+
+    def get(self, model: str, task_type: str, text: str) -> Optional[List[float]]:
+        return self.get_many(model, task_type, [text])[0]
+
+    def put_many(
+        self, model: str, task_type: str, texts: List[str], vectors: List[List[float]]
+    ):
+        """Append vectors to the cache. Safe to call from several processes."""
+        if not texts:
+            return
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimensions)
+        with self._lock, open(self.lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._load_index()
+                first_row = self._row_count()
+                # Drop the tail of a write torn by a killed run, so the new rows
+                # start exactly at first_row and the next index line starts on
+                # a line of its own
+                with open(self.vectors_path, "ab") as file:
+                    file.truncate(first_row * 4 * self.dimensions)
+                    file.write(matrix.tobytes())
+                with open(self.index_path, "a", encoding="utf-8") as file:
+                    file.truncate(self._index_offset)
+                    for i, text in enumerate(texts):
+                        file.write(
+                            f"{self.key(model, task_type, text)}\t{first_row + i}\n"
+                        )
+                self._load_index()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def put(self, model: str, task_type: str, text: str, vector: List[float]):
+        self.put_many(model, task_type, [text], [vector])
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+
+class QueryEmbeddingStore(SQLiteStore):
+    """Query embeddings shared by every worker process, in SQLite (WAL mode),
+    evicting expired and least recently hit entries past max_entries."""
+
+    table = "queries"
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = QUERY_CACHE_DISK_MAX_ENTRIES,
+        ttl_seconds: float = QUERY_CACHE_DISK_TTL_SECONDS,
+    ):
+        super().__init__(path, max_entries, ttl_seconds)
+        with self._connection as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS queries (
+                    model TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_hit_at REAL NOT NULL,
+                    PRIMARY KEY (model, query)
+                )
+                """
+            )
+            self._create_last_hit_index(connection)
+
+    def get_many(self, model: str, queries: List[str]) -> List[Optional[List[float]]]:
+        """Return the stored vector of every query, or None where it is missing or
+        expired."""
+        now = time.time()
+        vectors = []
+        with self._lock, self._connection as connection:
+            for query in queries:
+                row = connection.execute(
+                    """
+                    SELECT embedding FROM queries
+                    WHERE model = ? AND query = ? AND created_at > ?
+                    """,
+                    (model, query, now - self.ttl_seconds),
+                ).fetchone()
+                if row is None:
+                    vectors.append(None)
+                    continue
+                connection.execute(
+                    "UPDATE queries SET last_hit_at = ? WHERE model = ? AND query = ?",
+                    (now, model, query),
+                )
+                vectors.append(np.frombuffer(row[0], dtype=np.float32).tolist())
+        return vectors
+
+    def put_many(self, model: str, queries: List[str], vectors: List[List[float]]):
+        """Store vectors, then evict expired and least recently hit entries."""
+        now = time.time()
+        with self._lock, self._connection as connection:
+            connection.executemany(
+                """
+                INSERT OR REPLACE INTO queries
+                    (model, query, embedding, created_at, last_hit_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                [
+                    (
+                        model,
+                        query,
+                        np.asarray(vector, dtype=np.float32).tobytes(),
+                        now,
+                        now,
+                    )
+                    for query, vector in zip(queries, vectors)
+                ],
+            )
+            self._evict(connection, now)
+
+
+class DeterministicEmbeddings(Embeddings):
+    """Local fake embedder: a fixed pseudo-random unit vector per text, no API calls."""
+
+    model = "fake-deterministic"
+
+    def __init__(self, dimensions: int = EMBEDDING_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def _embed(self, text: str) -> List[float]:
+        seed = int(text_sha256(text)[:16], 16)
+        vector = np.random.default_rng(seed).standard_normal(self.dimensions)
+        return (vector / np.linalg.norm(vector)).astype(np.float32).tolist()
+
+    def embed_documents(self, texts: List[str], **kwargs) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that reads from and writes to an EmbeddingCache, and keeps
+    query embeddings in an LRU tier backed by an optional QueryEmbeddingStore."""
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model: str,
+        cache: EmbeddingCache,
+        query_cache: Optional[LRUCache] = None,
+        query_store: Optional[QueryEmbeddingStore] = None,
+    ):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache = cache
+        self.query_cache = query_cache or LRUCache(
+            QUERY_CACHE_SIZE, QUERY_CACHE_TTL_SECONDS
+        )
+        self.query_store = query_store
+
+    def _embed_many(self, texts: List[str], task_type: str) -> List[List[float]]:
+        vectors = self.cache.get_many(self.model, task_type, texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # Embed each distinct missing text once, in one batched request
+            missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+            embedded = self.embeddings.embed_documents(
+                missing_texts, task_type=task_type
+            )
+            self.cache.put_many(self.model, task_type, missing_texts, embedded)
+            by_text = dict(zip(missing_texts, embedded))
+            for i in missing:
+                vectors[i] = list(by_text[texts[i]])
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed_many(texts, "retrieval_document")
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed several queries, sending all cache misses in one request."""
+        keys = [normalize_query(text) for text in texts]
+        vectors = [self.query_cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # The normalized form is only the cache key: the API is sent the text
+            # of the first query missing under each key, as it was asked
+            first_texts = {}
+            for i in missing:
+                first_texts.setdefault(keys[i], texts[i])
+            missing_keys = list(first_texts)
+            embedded = self._embed_queries(missing_keys, list(first_texts.values()))
+            for key, vector in zip(missing_keys, embedded):
+                self.query_cache.put(key, list(vector))
+            by_key = dict(zip(missing_keys, embedded))
+            for i in missing:
+                vectors[i] = by_key[keys[i]]
+        return [list(vector) for vector in vectors]
+
+    def _embed_queries(self, keys: List[str], texts: List[str]) -> List[List[float]]:
+        """Embed queries through the shared store, when there is one, looked up by
+        their normalized keys."""
+        if self.query_store is None:
+            return self.embeddings.embed_documents(texts, task_type="retrieval_query")
+        vectors = self.query_store.get_many(self.model, keys)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            embedded = self.embeddings.embed_documents(
+                [texts[i] for i in missing], task_type="retrieval_query"
+            )
+            self.query_store.put_many(self.model, [keys[i] for i in missing], embedded)
+            for i, vector in zip(missing, embedded):
+                vectors[i] = list(vector)
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Return the process-wide embedding cache."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+        return _cache
+
+
+_query_store = None
+_query_store_pid = None
+
+
+def get_query_embedding_store() -> Optional[QueryEmbeddingStore]:
+    """Return the process-wide query embedding store, or None when
+    QUERY_CACHE_DISK=0."""
+    global _query_store, _query_store_pid
+    if not QUERY_CACHE_DISK:
+        return None
+    with _cache_lock:
+        # A forked worker opens its own SQLite connection
+        if _query_store is None or _query_store_pid != os.getpid():
+            _query_store = QueryEmbeddingStore(
+                os.path.join(EMBEDDING_CACHE_DIR, "queries.sqlite3")
+            )
+            _query_store_pid = os.getpid()
+        return _query_store
+
+
+def build_embeddings(
+    google_api_key: str, model: str = EMBEDDING_MODEL
+) -> CachedEmbeddings:
+    """Build the cached embedding client (EMBEDDING_BACKEND=fake for the local embedder)."""
+    if EMBEDDING_BACKEND == "fake":
+        return CachedEmbeddings(
+            DeterministicEmbeddings(),
+            DeterministicEmbeddings.model,
+            get_embedding_cache(),
+            query_store=get_query_embedding_store(),
+        )
+
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+    return CachedEmbeddings(
+        GoogleGenerativeAIEmbeddings(google_api_key=google_api_key, model=model),
+        model,
+        get_embedding_cache(),
+        query_store=get_query_embedding_store(),
+    )
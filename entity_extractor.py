@@ -0,0 +1,235 @@
+# Description: Tiered entity and intent extraction for process_query.
+# The first tier splits a question into ticket sections with keyword and regex rules,
+# helped by a lexicon learned from the ticket CSV (the symptoms of the titles and
+# the known priority, root cause and impact area values). Only when its confidence is
+# below ENTITY_CONFIDENCE_THRESHOLD is the question escalated to the LLM extractor.
+# Build the lexicon with: `python entity_extractor.py tickets_50.csv`
+
+from dotenv import load_dotenv
+import os
+import re
+import sys
+import csv
+import json
+import threading
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional
+
+load_dotenv()
+
+ENTITY_LEXICON_PATH = os.environ.get(
+    "ENTITY_LEXICON_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".entity_lexicon.json"),
+)
+ENTITY_CONFIDENCE_THRESHOLD = float(
+    os.environ.get("ENTITY_CONFIDENCE_THRESHOLD", "0.7")
+)
+
+# Problem words recognised even without a learned lexicon
+PROBLEM_TERMS = {
+    "error", "fail", "failure", "crash", "slow", "freez", "hang", "timeout", "lag",
+    "break", "broken", "down", "miss", "vanish", "disconnect", "stop", "drop",
+    "stuck", "late", "bug", "not", "cannot", "unable", "wrong", "duplicat",
+}  # fmt: skip
+
+# Leading words of a question that are not part of the problem itself
+BOILERPLATE = {
+    "how", "what", "why", "can", "could", "should", "do", "does", "did", "to", "i",
+    "we", "you", "is", "are", "there", "a", "an", "the", "this", "that", "issue",
+    "problem", "error", "bug", "ticket", "case", "where", "when", "in", "which",
+    "user", "users", "customer", "customers", "client", "clients", "someone", "saw",
+    "sees", "see", "seeing", "reported", "get", "gets", "got",
+    "experience", "experiences", "experienced", "face", "faces", "faced", "notice",
+    "noticed", "has", "have", "had", "fix", "reproduce", "resolve", "solve",
+    "debug", "troubleshoot", "handle", "explain", "about", "with", "for", "of",
+    "please", "help", "me", "us", "tell",
+}  # fmt: skip
+
+INTENT_RULES = [
+    ("reproduce issue", re.compile(r"\b(reproduc\w*|replicat\w*|steps?)\b", re.I)),
+    (
+        "fix solution",
+        re.compile(
+            r"\b(fix\w*|solv\w*|solution|resolv\w*|workaround|repair\w*|mitigat\w*)\b",
+            re.I,
+        ),
+    ),
+    ("root cause", re.compile(r"\b(why|caus\w*|reason|root)\b", re.I)),
+]
+
+# A clause describing what the user did, e.g. "when I switch to mode form"
+STEP_CUE = re.compile(
+    r"\b(?:steps?\s*:|(?:when|after|once|whenever)\s+(?:i|we|you|the user|users?)\b)",
+    re.I,
+)
+# Words that start the description of circumstances after the summary
+DESCRIPTION_CUE = re.compile(
+    r"\s*(?:,|;|\bwith\b|\bdue to\b|\bbecause\b|\bcaused by\b|\bsince\b|\bduring\b|"
+    r"\bwhile\b)\s*",
+    re.I,
+)
+# A trailing question after the step clause, e.g. ", how do I fix it"
+TRAILING_QUESTION = re.compile(
+    r"[,;]\s*(?:and\s+)?(?:how|what|why|can|could|should|please)\b.*$", re.I
+)
+
+
+def stem(word: str) -> str:
+    """Crude suffix stripping so 'freezes', 'freezing' and 'freeze' match."""
+    word = word.lower()
+    for suffix in ("ing", "es", "ed", "e", "s"):
+        if len(word) > len(suffix) + 3 and word.endswith(suffix):
+            return word[: -len(suffix)]
+    return word
+
+
+def words(text: str) -> List[str]:
+    return re.findall(r"[A-Za-z][A-Za-z'-]*", text)
+
+
+def build_lexicon(csv_file_name: str) -> Dict:
+    """Learn problem terms and description phrases from a ticket CSV."""
+    csv.field_size_limit(sys.maxsize)
+    problem_terms = Counter()
+    description_phrases = set()
+    with open(csv_file_name, mode="r", newline="", encoding="utf-8") as file:
+        for row in csv.DictReader(file):
+            # Titles are "<subject> <symptom> <adverb> <n>"; only the symptom is a
+            # problem term, the subject and adverb would count any mention of
+            # "reports" or "quickly" as a problem
+            title_words = words(row["Title"])
+            if len(title_words) >= 2:
+                problem_terms[stem(title_words[1])] += 1
+            for column in ("Priority", "Root_Cause", "Impact_Area"):
+                if row.get(column):
+                    description_phrases.add(row[column].lower())
+    return {
+        "problem_terms": dict(problem_terms),
+        "description_phrases": sorted(description_phrases),
+    }
+
+
+def load_lexicon(path: str = ENTITY_LEXICON_PATH) -> Optional[Dict]:
+    """Load the lexicon file, or learn it from CSV_FILE_NAME when there is none.
+    Relative paths are taken from the repository root, so the web apps find the
+    same files when they run from web/."""
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    path = os.path.join(repo_dir, path)
+    if os.path.exists(path):
+        with open(path, mode="r", encoding="utf-8") as file:
+            return json.load(file)
+    csv_file_name = os.environ.get("CSV_FILE_NAME")
+    if csv_file_name:
+        csv_file_name = os.path.join(repo_dir, csv_file_name)
+        if os.path.exists(csv_file_name):
+            return build_lexicon(csv_file_name)
+    print(
+        f"*** No entity lexicon at {path} nor a CSV_FILE_NAME to learn one from, "
+        "the rule tier uses its built-in problem terms only"
+    )
+    return None
+
+
+class TieredEntityExtractor:
+    """Rule tier first, LLM tier for the questions the rules are unsure about."""
+
+    def __init__(
+        self,
+        llm_extract: Callable[[str], Dict],
+        lexicon: Optional[Dict] = None,
+        threshold: float = ENTITY_CONFIDENCE_THRESHOLD,
+    ):
+        self.llm_extract = llm_extract
+        self.threshold = threshold
+        lexicon = lexicon or {}
+        self.problem_terms = PROBLEM_TERMS | set(lexicon.get("problem_terms", {}))
+        self.description_phrases = lexicon.get("description_phrases", [])
+        self._lock = threading.Lock()
+        self.counters = Counter({"rules": 0, "llm": 0})
+
+    def extract_with_rules(self, query: str) -> Dict:
+        """Split a question into sections and intents, with a confidence in [0, 1]."""
+        text = query.strip().rstrip("?.! ")
+        entities = {}
+        confidence = 0.0
+
+        intents = [intent for intent, rule in INTENT_RULES if rule.search(text)]
+        if intents:
+            confidence += 0.2
+        else:
+            intents = ["fix solution"]
+
+        step_match = STEP_CUE.search(text)
+        if step_match:
+            step = TRAILING_QUESTION.sub("", text[step_match.end() :]).strip(" :,")
+            if step:
+                entities["step to reproduce"] = step
+            text = text[: step_match.start()]
+
+        # The summary is the first clause without its question boilerplate,
+        # everything from the first description cue on is the description
+        description_match = DESCRIPTION_CUE.search(text)
+        head = text[: description_match.start()] if description_match else text
+        head_words = words(head)
+        while head_words and head_words[0].lower() in BOILERPLATE:
+            head_words.pop(0)
+        summary = " ".join(head_words)
+        if summary:
+            entities["issue summary"] = summary
+            if len(head_words) <= 8:
+                confidence += 0.3
+            problem_hits = sum(stem(w) in self.problem_terms for w in head_words)
+            confidence += min(problem_hits, 2) * 0.2
+
+        if description_match:
+            description = text[description_match.start() :].strip(" ,;")
+            if description:
+                entities["issue description"] = description
+                lowered = description.lower()
+                if any(phrase in lowered for phrase in self.description_phrases):
+                    confidence += 0.1
+
+        if not entities:
+            entities["issue summary"] = query
+        return {
+            "entities": entities,
+            "intents": intents,
+            "confidence": min(confidence, 1.0),
+        }
+
+    def extract(self, query: str) -> Dict:
+        """Return {"entities", "intents"}, from the rules when they are confident."""
+        result = self.extract_with_rules(query)
+        tier = "rules" if result["confidence"] >= self.threshold else "llm"
+        with self._lock:
+            self.counters[tier] += 1
+        if tier == "llm":
+            return self.llm_extract(query)
+        return {"entities": result["entities"], "intents": result["intents"]}
+
+    async def aextract(
+        self, query: str, allm_extract: Callable[[str], Awaitable[Dict]]
+    ) -> Dict:
+        """Async extract; allm_extract is the awaitable LLM tier."""
+        result = self.extract_with_rules(query)
+        tier = "rules" if result["confidence"] >= self.threshold else "llm"
+        with self._lock:
+            self.counters[tier] += 1
+        if tier == "llm":
+            return await allm_extract(query)
+        return {"entities": result["entities"], "intents": result["intents"]}
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(self.counters)
+
+
+if __name__ == "__main__":
+    csv_file_name = sys.argv[1] if len(sys.argv) > 1 else os.environ["CSV_FILE_NAME"]
+    lexicon = build_lexicon(csv_file_name)
+    with open(ENTITY_LEXICON_PATH, mode="w", encoding="utf-8") as file:
+        json.dump(lexicon, file, indent=2)
+    print(
+        f"Wrote {len(lexicon['problem_terms'])} problem terms and "
+        f"{len(lexicon['description_phrases'])} description phrases to {ENTITY_LEXICON_PATH}"
+    )
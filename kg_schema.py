@@ -0,0 +1,133 @@
+# Description: Schema bootstrap for the knowledge graph.
+# Creates every constraint, lookup index, fulltext index and vector index used by the
+# pipeline in one place, before any data is loaded, and records a schema version so
+# the step is skipped when the schema is already in place.
+
+from dotenv import load_dotenv
+import os
+from neo4j import GraphDatabase
+
+# Bump this when a statement below is added or changed
+SCHEMA_VERSION = 1
+
+CONSTRAINTS = [
+    "CREATE CONSTRAINT ticket_code IF NOT EXISTS FOR (t:Ticket) REQUIRE t.code IS UNIQUE",
+    "CREATE CONSTRAINT summary_hash IF NOT EXISTS FOR (s:Summary) REQUIRE s.hash IS UNIQUE",
+    "CREATE CONSTRAINT issue_description_hash IF NOT EXISTS FOR (id:IssueDescription) REQUIRE id.hash IS UNIQUE",
+    "CREATE CONSTRAINT step_reproduce_hash IF NOT EXISTS FOR (sr:StepReproduce) REQUIRE sr.hash IS UNIQUE",
+    "CREATE CONSTRAINT comments_hash IF NOT EXISTS FOR (c:Comments) REQUIRE c.hash IS UNIQUE",
+    "CREATE CONSTRAINT priority_value IF NOT EXISTS FOR (p:Priority) REQUIRE p.priority IS UNIQUE",
+    "CREATE CONSTRAINT root_cause_value IF NOT EXISTS FOR (rc:RootCause) REQUIRE rc.root_cause IS UNIQUE",
+    "CREATE CONSTRAINT impact_area_value IF NOT EXISTS FOR (ia:ImpactArea) REQUIRE ia.impact_area IS UNIQUE",
+    "CREATE CONSTRAINT schema_version_name IF NOT EXISTS FOR (v:SchemaVersion) REQUIRE v.name IS UNIQUE",
+]
+
+LOOKUP_INDEXES = [
+    "CREATE INDEX summary_ticket_code IF NOT EXISTS FOR (s:Summary) ON (s.ticket_code)",
+    "CREATE INDEX issue_description_ticket_code IF NOT EXISTS FOR (id:IssueDescription) ON (id.ticket_code)",
+    "CREATE INDEX step_reproduce_ticket_code IF NOT EXISTS FOR (sr:StepReproduce) ON (sr.ticket_code)",
+]
+
+# One entry per embedded section: the label, its text property, the relationship
+# from Ticket, and the fulltext and vector indexes built on it
+SECTION_INDEXES = [
+    {
+        "label": "Summary",
+        "text_property": "summary",
+        "relationship": "HAS_SUMMARY",
+        "fulltext_index": "summary_fulltext",
+        "vector_index": "summary_embeddings",
+        "similarity": "cosine",
+    },
+    {
+        "label": "IssueDescription",
+        "text_property": "description",
+        "relationship": "HAS_ISSUE_DESCRIPTION",
+        "fulltext_index": "issue_description_fulltext",
+        "vector_index": "issue_description_embeddings",
+        "similarity": "cosine",
+    },
+    {
+        "label": "StepReproduce",
+        "text_property": "step",
+        "relationship": "HAS_STEPS_TO_REPRODUCE",
+        "fulltext_index": "step_reproduce_fulltext",
+        "vector_index": "step_reproduce_embeddings",
+        "similarity": "cosine",
+    },
+]
+
+EMBEDDING_DIMENSIONS = 768
+
+
+def fulltext_index_statement(spec):
+    return (
+        f"CREATE FULLTEXT INDEX {spec['fulltext_index']} IF NOT EXISTS "
+        f"FOR (n:{spec['label']}) ON EACH [n.{spec['text_property']}]"
+    )
+
+
+def vector_index_statement(spec):
+    return f"""
+    CREATE VECTOR INDEX {spec['vector_index']} IF NOT EXISTS
+    FOR (n:{spec['label']}) ON (n.embedding)
+    OPTIONS {{
+        indexConfig: {{
+            `vector.dimensions`: {EMBEDDING_DIMENSIONS},
+            `vector.similarity_function`: '{spec['similarity']}'
+        }}
+    }}
+    """
+
+
+FULLTEXT_INDEXES = [fulltext_index_statement(spec) for spec in SECTION_INDEXES]
+VECTOR_INDEXES = [vector_index_statement(spec) for spec in SECTION_INDEXES]
+
+
+def get_schema_version(session):
+    """Return the schema version recorded in the graph, or 0 if there is none."""
+    record = session.run(
+        "MATCH (v:SchemaVersion {name: 'kg'}) RETURN v.version AS version"
+    ).single()
+    return record["version"] if record else 0
+
+
+def bootstrap_schema(driver, database, force=False):
+    """Create all constraints and indexes unless the recorded version is current."""
+    with driver.session(database=database) as session:
+        version = get_schema_version(session)
+        if version >= SCHEMA_VERSION and not force:
+            print(f"Schema version {version} already in place, skipping bootstrap.")
+            return False
+
+        print(f"Bootstrapping schema version {SCHEMA_VERSION}...")
+        for statement in (
+            CONSTRAINTS + LOOKUP_INDEXES + FULLTEXT_INDEXES + VECTOR_INDEXES
+        ):
+            session.run(statement)
+
+        # Wait until the new indexes are online before loading against them
+        session.run("CALL db.awaitIndexes(300)")
+        session.run(
+            """
+            MERGE (v:SchemaVersion {name: 'kg'})
+            SET v.version = $version, v.updated_at = datetime()
+            """,
+            version=SCHEMA_VERSION,
+        )
+        print("Schema bootstrapped successfully.")
+        return True
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    NEO4J_URI = os.environ["NEO4J_URI"]
+    NEO4J_USERNAME = os.environ["NEO4J_USERNAME"]
+    NEO4J_PASSWORD = os.environ["NEO4J_PASSWORD"]
+    NEO4J_DATABASE = os.environ["NEO4J_DATABASE"]
+    AUTH = (NEO4J_USERNAME, NEO4J_PASSWORD)
+
+    driver = GraphDatabase.driver(NEO4J_URI, auth=AUTH)
+    bootstrap_schema(driver, NEO4J_DATABASE, force=True)
+    driver.close()
@@ -0,0 +1,403 @@
+# Description: Optional in-process vector index over the section embeddings.
+# The `embedding` and owning ticket code of every Summary, IssueDescription and
+# StepReproduce node are exported from Neo4j into a memory-mapped float32 matrix per
+# label, partitioned by an IVF (inverted file) index trained with k-means in NumPy.
+# With RETRIEVER_BACKEND=local, retriever.py searches it instead of the Neo4j vector
+# indexes. Refreshes only fetch the embeddings of nodes not yet in the snapshot.
+
+from dotenv import load_dotenv
+import os
+import json
+import time
+import fcntl
+import threading
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from kg_schema import SECTION_INDEXES, EMBEDDING_DIMENSIONS
+
+load_dotenv()
+
+LOCAL_INDEX_DIR = os.environ.get(
+    "LOCAL_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".local_index"),
+)
+# IVF lists scanned per query; below LOCAL_INDEX_MIN_IVF_ROWS every row is scanned
+LOCAL_INDEX_NPROBE = int(os.environ.get("LOCAL_INDEX_NPROBE", "8"))
+LOCAL_INDEX_MIN_IVF_ROWS = int(os.environ.get("LOCAL_INDEX_MIN_IVF_ROWS", "2048"))
+# Embeddings fetched from Neo4j per query during a refresh
+LOCAL_INDEX_FETCH_SIZE = int(os.environ.get("LOCAL_INDEX_FETCH_SIZE", "1000"))
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_SIZE = 50000
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scale rows to unit length so a dot product is the cosine similarity."""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, seed: int = 0) -> np.ndarray:
+    """Spherical k-means over unit vectors; returns unit-length centroids."""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > KMEANS_SAMPLE_SIZE:
+        vectors = vectors[rng.choice(len(vectors), KMEANS_SAMPLE_SIZE, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        # Empty clusters keep their previous centroid
+        centroids = np.where(counts[:, None] > 0, normalize(sums), centroids)
+    return centroids.astype(np.float32)
+
+
+class Snapshot:
+    """Immutable view of one label's index; replaced as a whole on refresh."""
+
+    def __init__(self, matrix, rows, hashes, ticket_codes, lists, centroids):
+        self.matrix = matrix
+        self.rows = rows
+        self.hashes = hashes
+        self.ticket_codes = ticket_codes
+        self.lists = lists
+        self.centroids = centroids
+        # Positions of the entries of every IVF list, so a probe is a concatenation
+        self.members = {}
+        if centroids is not None:
+            order = np.argsort(lists, kind="stable")
+            bounds = np.searchsorted(lists[order], np.arange(len(centroids) + 1))
+            self.members = {
+                c: order[bounds[c] : bounds[c + 1]] for c in range(len(centroids))
+            }
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def search(
+        self, vector: List[float], k: int, nprobe: int = LOCAL_INDEX_NPROBE
+    ) -> List[Tuple[str, float]]:
+        """Return the top-k (ticket_code, score) hits, scored like a Neo4j cosine index."""
+        if not len(self.rows):
+            return []
+        query = normalize(np.asarray(vector, dtype=np.float32))
+        if self.centroids is None or nprobe >= len(self.centroids):
+            candidates = np.arange(len(self.rows))
+        else:
+            probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+            candidates = np.concatenate([self.members[c] for c in probe])
+
+        scores = self.matrix[self.rows[candidates]] @ query
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [
+            (self.ticket_codes[candidates[i]], float((1 + scores[i]) / 2)) for i in top
+        ]
+
+
+class SectionIndex:
+    """On-disk IVF index of one section label: vectors.<generation>.f32 holds unit
+    vectors, rows.tsv names that file and maps each live node hash to its row, ticket
+    code and IVF list. Compaction starts a new generation, so replacing rows.tsv
+    switches rows and vectors together."""
+
+    def __init__(
+        self,
+        label: str,
+        directory: str = LOCAL_INDEX_DIR,
+        dimensions: int = EMBEDDING_DIMENSIONS,
+    ):
+        self.label = label
+        self.dimensions = dimensions
+        self.directory = os.path.join(directory, label)
+        # Snapshots written before generations were introduced use vectors.f32
+        self.vectors_file = "vectors.f32"
+        self.rows_path = os.path.join(self.directory, "rows.tsv")
+        self.centroids_path = os.path.join(self.directory, "centroids.npy")
+        self.meta_path = os.path.join(self.directory, "meta.json")
+        self.lock_path = os.path.join(self.directory, "index.lock")
+        self.snapshot = Snapshot(None, np.zeros(0, np.int64), [], [], None, None)
+        self.trained_rows = 0
+        self._loaded_mtime = None
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, open(self.lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            try:
+                self._load()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @property
+    def vectors_path(self) -> str:
+        return os.path.join(self.directory, self.vectors_file)
+
+    def _next_vectors_file(self) -> str:
+        parts = self.vectors_file.split(".")
+        generation = int(parts[1]) if len(parts) == 3 else 0
+        return f"vectors.{generation + 1}.f32"
+
+    def _remove_old_generations(self):
+        """Delete vector files rows.tsv no longer names, including one a compaction
+        left behind when it was interrupted before rows.tsv was replaced."""
+        for name in os.listdir(self.directory):
+            if (
+                name.startswith("vectors.")
+                and name.endswith(".f32")
+                and name != self.vectors_file
+            ):
+                os.remove(os.path.join(self.directory, name))
+
+    def _file_rows(self, vectors_path: str) -> int:
+        if not os.path.exists(vectors_path):
+            return 0
+        return os.path.getsize(vectors_path) // (4 * self.dimensions)
+
+    def _load(self):
+        """Open the snapshot last written to disk (by any process), if it changed."""
+        if not os.path.exists(self.rows_path):
+            return
+        mtime = os.stat(self.rows_path).st_mtime_ns
+        if mtime == self._loaded_mtime:
+            return
+
+        rows, hashes, ticket_codes, lists = [], [], [], []
+        vectors_file = "vectors.f32"
+        with open(self.rows_path, mode="r", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith("#"):
+                    vectors_file = line[1:].strip()
+                    continue
+                row, node_hash, ticket_code, ivf_list = line.rstrip("\n").split("\t")
+                rows.append(int(row))
+                hashes.append(node_hash)
+                ticket_codes.append(ticket_code)
+                lists.append(int(ivf_list))
+        centroids = (
+            np.load(self.centroids_path)
+            if os.path.exists(self.centroids_path)
+            else None
+        )
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, mode="r", encoding="utf-8") as file:
+                self.trained_rows = json.load(file)["trained_rows"]
+
+        self.vectors_file = vectors_file
+        file_rows = self._file_rows(self.vectors_path)
+        matrix = None
+        if file_rows:
+            matrix = np.memmap(
+                self.vectors_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(file_rows, self.dimensions),
+            )
+        self.snapshot = Snapshot(
+            matrix,
+            np.asarray(rows, dtype=np.int64),
+            hashes,
+            ticket_codes,
+            np.asarray(lists, dtype=np.int64),
+            centroids,
+        )
+        self._loaded_mtime = mtime
+
+    def _write_atomic(self, path: str, write):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as file:
+            write(file)
+        os.replace(tmp_path, path)
+
+    def _fetch_embeddings(self, graph, hashes: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(hashes), self.dimensions), dtype=np.float32)
+        position = {node_hash: i for i, node_hash in enumerate(hashes)}
+        for start in range(0, len(hashes), LOCAL_INDEX_FETCH_SIZE):
+            rows = graph.query(
+                f"""
+                UNWIND $hashes AS hash
+                MATCH (n:`{self.label}` {{hash: hash}})
+                RETURN n.hash AS hash, n.embedding AS embedding
+                """,
+                {"hashes": hashes[start : start + LOCAL_INDEX_FETCH_SIZE]},
+            )
+            for row in rows:
+                vectors[position[row["hash"]]] = row["embedding"]
+        return normalize(vectors)
+
+    def refresh(self, graph) -> Dict:
+        """Bring the snapshot in line with the graph, fetching only new embeddings."""
+        with self._lock, open(self.lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                return self._refresh(graph)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self, graph) -> Dict:
+        self._load()
+        self._remove_old_generations()
+        snapshot = self.snapshot
+        current = graph.query(
+            f"""
+            MATCH (n:`{self.label}`) WHERE n.embedding IS NOT NULL
+            RETURN n.hash AS hash, coalesce(n.ticket_code,
+                head([(t:Ticket)-->(n) | t.code])) AS ticket_code
+            """
+        )
+        current = [row for row in current if row["ticket_code"]]
+        known = {node_hash: i for i, node_hash in enumerate(snapshot.hashes)}
+        new_hashes = [row["hash"] for row in current if row["hash"] not in known]
+        removed = len(known) - (len(current) - len(new_hashes))
+        changed_codes = sum(
+            1
+            for row in current
+            if row["hash"] in known
+            and snapshot.ticket_codes[known[row["hash"]]] != row["ticket_code"]
+        )
+        if not new_hashes and not removed and not changed_codes:
+            return {
+                "label": self.label,
+                "rows": len(snapshot),
+                "added": 0,
+                "removed": 0,
+            }
+
+        # Append the new vectors; rows of removed nodes stay in the file until the
+        # dead rows outnumber the live ones, then the live rows are copied to the
+        # next generation's file. The current file is left alone until rows.tsv
+        # names its successor, so a crash mid-compaction keeps a consistent pair
+        vectors_file, vectors_path = self.vectors_file, self.vectors_path
+        file_rows = self._file_rows(vectors_path)
+        live_old = [known[row["hash"]] for row in current if row["hash"] in known]
+        if file_rows and file_rows - len(live_old) > len(current):
+            kept = snapshot.matrix[snapshot.rows[live_old]]
+            vectors_file = self._next_vectors_file()
+            vectors_path = os.path.join(self.directory, vectors_file)
+            self._write_atomic(vectors_path, lambda f: f.write(kept.tobytes()))
+            old_rows = dict(zip(live_old, range(len(live_old))))
+            file_rows = len(live_old)
+        else:
+            old_rows = {i: int(snapshot.rows[i]) for i in live_old}
+
+        if new_hashes:
+            new_vectors = self._fetch_embeddings(graph, new_hashes)
+            with open(vectors_path, "ab") as file:
+                # Drop the partial row a torn append may have left, so the new rows
+                # start where file_rows says they do
+                file.truncate(file_rows * 4 * self.dimensions)
+                file.write(new_vectors.tobytes())
+        new_rows = {node_hash: file_rows + i for i, node_hash in enumerate(new_hashes)}
+
+        rows = np.asarray(
+            [
+                (
+                    old_rows[known[row["hash"]]]
+                    if row["hash"] in known
+                    else new_rows[row["hash"]]
+                )
+                for row in current
+            ],
+            dtype=np.int64,
+        )
+        matrix = np.memmap(
+            vectors_path,
+            dtype=np.float32,
+            mode="r",
+            shape=(self._file_rows(vectors_path), self.dimensions),
+        )
+
+        # Retrain the IVF lists once the index has doubled since the last training;
+        # otherwise keep existing assignments and place new rows in their nearest list
+        centroids = snapshot.centroids
+        if len(current) < LOCAL_INDEX_MIN_IVF_ROWS:
+            centroids, lists = None, np.zeros(len(current), dtype=np.int64)
+        elif centroids is None or len(current) >= 2 * self.trained_rows:
+            vectors = np.asarray(matrix[rows])
+            centroids = kmeans(vectors, int(np.sqrt(len(current))))
+            lists = np.argmax(vectors @ centroids.T, axis=1)
+            self.trained_rows = len(current)
+        else:
+            lists = np.asarray(
+                [
+                    snapshot.lists[known[row["hash"]]] if row["hash"] in known else -1
+                    for row in current
+                ],
+                dtype=np.int64,
+            )
+            fresh = np.flatnonzero(lists < 0)
+            if len(fresh):
+                lists[fresh] = np.argmax(matrix[rows[fresh]] @ centroids.T, axis=1)
+
+        # rows.tsv is written last: it is what readers check to pick up a snapshot
+        if centroids is None:
+            if os.path.exists(self.centroids_path):
+                os.remove(self.centroids_path)
+        else:
+            self._write_atomic(self.centroids_path, lambda f: np.save(f, centroids))
+        meta = json.dumps({"trained_rows": self.trained_rows, "refreshed": time.time()})
+        self._write_atomic(self.meta_path, lambda f: f.write(meta.encode("utf-8")))
+        lines = f"#{vectors_file}\n" + "".join(
+            f"{row_id}\t{row['hash']}\t{row['ticket_code']}\t{ivf_list}\n"
+            for row_id, row, ivf_list in zip(rows, current, lists)
+        )
+        self._write_atomic(self.rows_path, lambda f: f.write(lines.encode("utf-8")))
+        self._load()
+        # Readers still mapping an older generation keep it until they reload
+        self._remove_old_generations()
+        return {
+            "label": self.label,
+            "rows": len(current),
+            "added": len(new_hashes),
+            "removed": removed,
+        }
+
+    def search(self, vector: List[float], k: int) -> List[Tuple[str, float]]:
+        return self.snapshot.search(vector, k)
+
+
+class LocalIndex:
+    """Section indexes of every label in SECTION_INDEXES."""
+
+    def __init__(self, directory: str = LOCAL_INDEX_DIR):
+        self.sections = {
+            spec["label"]: SectionIndex(spec["label"], directory)
+            for spec in SECTION_INDEXES
+        }
+        self.refreshed_at: Optional[float] = None
+
+    def refresh(self, graph) -> List[Dict]:
+        reports = [section.refresh(graph) for section in self.sections.values()]
+        self.refreshed_at = time.time()
+        return reports
+
+    def search(
+        self, label: str, vector: List[float], k: int
+    ) -> List[Tuple[str, float]]:
+        return self.sections[label].search(vector, k)
+
+    def stats(self) -> Dict:
+        return {
+            "refreshed_at": self.refreshed_at,
+            "rows": {label: len(s.snapshot) for label, s in self.sections.items()},
+        }
+
+
+if __name__ == "__main__":
+    from langchain_neo4j import Neo4jGraph
+
+    graph = Neo4jGraph(
+        url=os.environ["NEO4J_URI"],
+        username=os.environ["NEO4J_USERNAME"],
+        password=os.environ["NEO4J_PASSWORD"],
+        database=os.environ["NEO4J_DATABASE"],
+        refresh_schema=False,
+    )
+    start = time.time()
+    for report in LocalIndex().refresh(graph):
+        print(report)
+    print(f"Local index refreshed in {time.time() - start:.2f}s")
+    graph.close()
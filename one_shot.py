@@ -0,0 +1,85 @@
+# Description: One-shot pipeline mode for process_query (PIPELINE_MODE=one_shot).
+# Instead of extracting entities with the LLM, retrieving, and then answering with a
+# second LLM call, the raw question is searched in every section index (vector and
+# fulltext, fused), the candidates' subgraph is fetched with the fields of every
+# intent, and a single LLM call returns the entities, intents and answer together as
+# JSON. The response keeps the shape of the staged pipeline's.
+# Compare both modes with: `python 5_benchmark_pipeline_modes.py`
+
+from dotenv import load_dotenv
+import os
+import re
+import json
+from typing import Dict
+from langchain_core.language_models import BaseChatModel
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from retriever import SECTION_LABELS
+from cypher_templates import DEFAULT_INTENT, INTENT_TEMPLATES
+
+load_dotenv()
+
+# "staged" (entities, retrieval, answer) or "one_shot"
+PIPELINE_MODE = os.environ.get("PIPELINE_MODE", "staged")
+
+# The intents are only known after the LLM call, so the subgraph covers all of them
+ONE_SHOT_INTENTS = list(INTENT_TEMPLATES)
+
+one_shot_prompt = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "You are a customer support expert. From the customer query, extract problem-related entities as a "
+            "dictionary mapping ticket sections ('issue summary', 'issue description', 'step to reproduce') to the "
+            "specific issues, and the intents as a list of actionable goals (e.g., 'fix solution', 'reproduce "
+            "issue'). Then answer the query concisely from the retrieved ticket data. Return strictly a JSON object "
+            "with double quotes in the format: "
+            '{{"entities": {{"issue summary": "..."}}, "intents": ["..."], "answer": "..."}}.',
+        ),
+        (
+            "human",
+            "Query: {query}\nContext:\n{context}",
+        ),
+    ]
+)
+
+
+def raw_question_entities(query: str) -> Dict[str, str]:
+    """Search every section with the question as it was asked."""
+    return {section: query for section in SECTION_LABELS}
+
+
+def build_one_shot_chain(llm: BaseChatModel, query: str, context: str):
+    """Build the single call returning entities, intents and answer as JSON text."""
+    # Passed as variables, so braces in the question or the tickets are not parsed
+    prompt = one_shot_prompt.partial(query=query, context=context)
+    return prompt | llm | StrOutputParser()
+
+
+def parse_one_shot_output(text: str, query: str) -> Dict:
+    """Parse the JSON of the one-shot call; when it is not JSON, the whole text is
+    taken as the answer and the entities and intents fall back to defaults."""
+    parsed = {}
+    json_match = re.search(r"\{.*\}", text, re.DOTALL)
+    if json_match:
+        try:
+            parsed = json.loads(json_match.group(0))
+        except json.JSONDecodeError as e:
+            print(f"Error parsing JSON string: {e}, Raw response: {text}")
+    if not isinstance(parsed, dict):
+        parsed = {}
+
+    entities = parsed.get("entities")
+    if not isinstance(entities, dict) or not entities:
+        entities = {"issue summary": query}
+    intents = parsed.get("intents")
+    if not isinstance(intents, list) or not intents:
+        intents = [DEFAULT_INTENT]
+    answer = parsed.get("answer")
+    if not isinstance(answer, str) or not answer:
+        answer = text.strip()
+    return {
+        "entities": {str(key): str(value) for key, value in entities.items()},
+        "intents": [str(intent) for intent in intents],
+        "answer": answer,
+    }
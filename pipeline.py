@@ -0,0 +1,604 @@
+# Description: The question answering pipeline shared by 4_rag_chain.py, web/app.py and
+# web/asgi_app.py. 3.2.1 extracts entities and intents from the question, 3.2.2
+# retrieves the candidate tickets and their subgraph, and 3.2.3 generates the answer,
+# each stage within its latency budget. PIPELINE_MODE=one_shot retrieves on the raw
+# question and gets entities, intents and answer from a single LLM call instead.
+# The pipeline runs as a generator of (event, data) pairs, with a coroutine version
+# on the async Neo4j driver for the ASGI app; process_query keeps only the response.
+
+from dotenv import load_dotenv
+import os
+import json
+import re
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnablePassthrough, RunnableParallel
+from pydantic import BaseModel, Field
+from retriever import DEFAULT_TICKET_ID, AsyncTicketRetriever, get_retriever
+from cypher_templates import (
+    SUBGRAPH_FAN_OUT,
+    build_neighbourhood_query,
+    format_neighbourhood,
+    neighbourhood_fingerprints,
+)
+from context_packer import pack_context
+from answer_cache import get_answer_cache
+from entity_extractor import TieredEntityExtractor, load_lexicon
+from one_shot import (
+    ONE_SHOT_INTENTS,
+    PIPELINE_MODE,
+    build_one_shot_chain,
+    parse_one_shot_output,
+    raw_question_entities,
+)
+from stage_budget import (
+    StageBudgetExceeded,
+    arun_stage,
+    astream_stage,
+    run_stage,
+    start_stage,
+    stream_stage,
+)
+
+# Configure logging to suppress Neo4j warnings
+logging.getLogger("neo4j").setLevel(logging.ERROR)
+
+# Load environment variables
+load_dotenv()
+GOOGLE_API_KEY = os.environ["GOOGLE_API_KEY"]
+
+# The Neo4j graph and the section vector indexes live in the shared retriever,
+# which attaches to the existing indexes on first use instead of at import time
+
+# Initialize Google Gemini API
+llm = ChatGoogleGenerativeAI(google_api_key=GOOGLE_API_KEY, model="gemini-1.5-flash")
+
+# No stage consumes the rephrased query, so it is only generated (concurrently
+# with subgraph retrieval) when REPHRASE_QUERY=1, e.g. to inspect it in the logs
+REPHRASE_QUERY = os.environ.get("REPHRASE_QUERY", "0") == "1"
+
+# Rephrase tasks nothing awaits, referenced until they finish so the event loop's
+# weak references are not the only ones
+_rephrase_tasks = set()
+
+NO_ANSWER = "Sorry, no answer could be generated in time. Please try again."
+
+
+# 3.2.1 Query Entity Identification and Intent Detection
+class IssueEntities(BaseModel):
+    """Model for extracting problem-related entities and intents from customer support tickets."""
+
+    entities: Dict[str, str] = Field(
+        ...,
+        description=(
+            "A dictionary of problem-related entities extracted from customer support tickets, where keys are sections "
+            "from the ticket template (e.g., 'issue summary', 'issue description', 'step to reproduce') and values are "
+            "specific issues, troubles, or technical difficulties (e.g., 'csv upload error', 'login issue', 'slow "
+            "response time'). The extraction should focus on key problem terms or phrases relevant to the ticket "
+            "context, excluding generic terms (e.g., 'reported', 'investigating', 'user'), status updates, or "
+            "procedural notes unless part of a problem description. For example, in 'User reported a login issue and "
+            "slow response time while accessing the app', the entities would be {'issue summary': 'login issue', "
+            "'issue description': 'slow response time while accessing the app'}."
+        ),
+    )
+    intents: List[str] = Field(
+        ...,
+        description=(
+            "A list of query intents representing the user's goal (e.g., 'fix solution', 'reproduce issue'), derived "
+            "from the entities and context of the ticket. Intents should reflect actionable outcomes relevant to the "
+            "query, such as providing a solution or steps to reproduce."
+        ),
+    )
+
+
+# Fallback parsing for plain text responses
+def fallback_parse_text(text: str, query: str) -> Dict:
+    """Extract entities and intents from plain text if JSON parsing fails."""
+    entities = {}
+    intents = []
+
+    # Look for common issue-related phrases
+    if "error" in query.lower():
+        entities["issue summary"] = " ".join(
+            [word for word in query.split() if "error" in word.lower()]
+        )
+    elif "issue" in query.lower():
+        entities["issue summary"] = " ".join(
+            [word for word in query.split() if "issue" in word.lower()]
+        )
+
+    # Look for additional descriptions
+    if "priority" in query.lower() or "due to" in query.lower():
+        entities["issue description"] = query
+
+    # Determine intents based on keywords
+    if "how to reproduce" in query.lower():
+        intents.append("reproduce issue")
+    else:
+        intents.append("fix solution")
+
+    # If no entities were extracted, use a default
+    if not entities:
+        entities["issue summary"] = query
+
+    return {"entities": entities, "intents": intents}
+
+
+# Custom parsing function to handle JSON string outputs
+def parse_structured_output(response: str, query: str) -> Dict:
+    """Parse the structured output from Gemini API, handling both dict and JSON string cases."""
+    if isinstance(response, dict):
+        return response
+    elif isinstance(response, str):
+        # Try to extract JSON from the response using regex
+        json_match = re.search(r"\{.*\}", response, re.DOTALL)
+        if json_match:
+            json_str = json_match.group(0)
+            try:
+                return json.loads(json_str)  # Parse JSON string into a dictionary
+            except json.JSONDecodeError as e:
+                print(f"Error parsing JSON string: {e}, Raw response: {response}")
+        print(
+            f"Could not parse response as JSON, falling back to text parsing: {response}"
+        )
+        return fallback_parse_text(response, query)
+    else:
+        print(f"Unexpected response type: {type(response)}, Response: {response}")
+        return fallback_parse_text(str(response), query)
+
+
+# Create the entity chain with custom parsing
+entity_prompt = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "You are an expert in analyzing customer support tickets, tasked with extracting problem-related entities "
+            "and intents. Extract entities as a dictionary mapping ticket sections (e.g., 'issue summary', 'issue "
+            "description', 'step to reproduce') to specific issues, troubles, or technical difficulties. Identify "
+            "intents as a list of actionable goals (e.g., 'fix solution', 'reproduce issue'). Exclude generic terms "
+            "(e.g., 'reported', 'investigating', 'user'), status updates, or procedural notes unless part of a problem "
+            "description. Return the entities and intents based on the ticket context as a valid JSON object in the "
+            "format: {{'entities': {{'issue summary': '...', 'issue description': '...'}}, 'intents': ['...']}}. "
+            "Ensure the output is strictly a JSON object with proper syntax (e.g., use double quotes for keys and values).",
+        ),
+        (
+            "human",
+            "Extract problem-related entities and intents from the following customer support ticket: {question}",
+        ),
+    ]
+)
+
+# Use RunnableParallel to carry the input query alongside the LLM output
+entity_chain = (
+    RunnableParallel(response=entity_prompt | llm, query=RunnablePassthrough())
+    | (lambda x: parse_structured_output(x["response"].content, x["query"]["question"]))
+    | (lambda x: IssueEntities(**x))
+)
+
+# Routine questions are split by the local rule tier; the LLM chain above only
+# sees the ones the rules are not confident about
+entity_extractor = TieredEntityExtractor(
+    lambda query: entity_chain.invoke({"question": query}).model_dump(),
+    load_lexicon(),
+)
+
+
+def extract_entities(query: str) -> IssueEntities:
+    """Extract entities and intents, escalating to the LLM only when needed."""
+    return IssueEntities(**entity_extractor.extract(query))
+
+
+def fallback_entities(query: str) -> IssueEntities:
+    """Entities and intents used when extraction fails or runs out of time."""
+    return IssueEntities(entities={"issue summary": query}, intents=["reproduce issue"])
+
+
+async def extract_entities_with_llm(query: str) -> Dict:
+    """Async LLM tier of the entity extractor."""
+    return (await entity_chain.ainvoke({"question": query})).model_dump()
+
+
+# 3.2.2 Embedding-based Retrieval of Sub-graphs
+def get_candidate_ticket_ids(entities: Dict[str, str]) -> List[str]:
+    """Retrieve the best ticket IDs using embedding-based retrieval across multiple sections."""
+    return get_retriever().get_candidate_ticket_ids(entities)
+
+
+def build_rephrase_chain(original_query: str, ticket_id: str):
+    """Build the chain rephrasing the query to include the ticket ID."""
+    rephrase_prompt = ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                "You are reformulating customer support queries to include a ticket ID for subgraph extraction.",
+            ),
+            (
+                "human",
+                f"Original query: {original_query}\nRetrieved ticket ID: {ticket_id}\nRephrase the query to include the ticket ID:",
+            ),
+        ]
+    )
+    return rephrase_prompt | llm | StrOutputParser()
+
+
+def rephrase_query(original_query: str, ticket_id: str) -> str:
+    """Rephrase the query to include the ticket ID using LLM."""
+    return build_rephrase_chain(original_query, ticket_id).invoke({})
+
+
+def log_rephrased_query(future):
+    """Done-callback of the rephrase future or task."""
+    _rephrase_tasks.discard(future)
+    if future.cancelled():
+        return
+    if future.exception() is not None:
+        print(f"Error rephrasing query: {future.exception()}")
+        return
+    print(f"*** Rephrased Query: {future.result()}")
+
+
+def generate_cypher_query(intents: List[str]) -> str:
+    """Generate one Cypher query expanding the candidate tickets with the fields
+    every detected intent needs."""
+    return build_neighbourhood_query(intents)
+
+
+def retrieve_subgraph(
+    ticket_ids: List[str], intents: List[str]
+) -> Tuple[Dict, Dict[str, int]]:
+    """Retrieve the subgraph around the candidate tickets in one round trip, with
+    the version of every ticket in it."""
+    cypher_query = generate_cypher_query(intents)
+    result = get_retriever().graph.query(
+        cypher_query, {"ids": ticket_ids, "fan_out": SUBGRAPH_FAN_OUT}
+    )
+    return format_neighbourhood(ticket_ids, result), neighbourhood_fingerprints(result)
+
+
+async def aretrieve_subgraph(
+    retriever: AsyncTicketRetriever, ticket_ids: List[str], intents: List[str]
+) -> Tuple[Dict, Dict[str, int]]:
+    """Async version of retrieve_subgraph."""
+    cypher_query = generate_cypher_query(intents)
+    result = await retriever.query(
+        cypher_query, {"ids": ticket_ids, "fan_out": SUBGRAPH_FAN_OUT}
+    )
+    return format_neighbourhood(ticket_ids, result), neighbourhood_fingerprints(result)
+
+
+# 3.2.3 Answer Generation
+def build_answer_chain(query: str, context: str):
+    """Build the answer chain from the packed context."""
+    answer_prompt = ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                "You are a customer support expert generating answers based on retrieved ticket data.",
+            ),
+            (
+                "human",
+                "Query: {query}\nContext:\n{context}\nProvide a concise answer:",
+            ),
+        ]
+    )
+    # The ticket text is passed as a variable, so braces in it are not parsed
+    answer_prompt = answer_prompt.partial(query=query, context=context)
+    return answer_prompt | llm | StrOutputParser()
+
+
+def generate_answer(query: str, context: Dict) -> str:
+    """Generate a natural language answer using LLM."""
+    packed = pack_context(query, context, get_retriever().embeddings)
+    return build_answer_chain(query, packed).invoke({})
+
+
+def stream_answer(query: str, context: Dict) -> Iterator[str]:
+    """Generate the answer as a stream of text chunks."""
+    packed = pack_context(query, context, get_retriever().embeddings)
+    return build_answer_chain(query, packed).stream({})
+
+
+def generate_one_shot(query: str, context: Dict) -> Dict:
+    """Extract entities and intents and answer in a single LLM call."""
+    packed = pack_context(query, context, get_retriever().embeddings)
+    text = build_one_shot_chain(llm, query, packed).invoke({})
+    return parse_one_shot_output(text, query)
+
+
+async def agenerate_one_shot(query: str, context: str) -> Dict:
+    """Async version of generate_one_shot, from the packed context."""
+    text = await build_one_shot_chain(llm, query, context).ainvoke({})
+    return parse_one_shot_output(text, query)
+
+
+def stream_answer_events(query: str, context: Dict):
+    """Yield "token" events for the answer; return (answer, complete), where the
+    answer is cut short if the answer budget ran out before the stream ended, even
+    while waiting for a chunk."""
+    chunks = []
+    try:
+        for chunk in stream_stage("answer", stream_answer, query, context):
+            chunks.append(chunk)
+            yield "token", {"text": chunk}
+    except StageBudgetExceeded:
+        return "".join(chunks), False
+    return "".join(chunks), True
+
+
+async def astream_answer_events(query: str, context: str):
+    """Async version of stream_answer_events, from the packed context; the final
+    "answer" event carries (answer, complete)."""
+    chunks = []
+    stream = build_answer_chain(query, context).astream({})
+    try:
+        async for chunk in astream_stage("answer", stream):
+            chunks.append(chunk)
+            yield "token", {"text": chunk}
+    except StageBudgetExceeded:
+        yield "answer", ("".join(chunks), False)
+        return
+    yield "answer", ("".join(chunks), True)
+
+
+def subgraph_timeout(ticket_id: str) -> Dict:
+    """subgraph_data when the subgraph stage runs out of time."""
+    return {"error": "Subgraph retrieval timed out for " + ticket_id}
+
+
+def one_shot_result(result: Optional[Dict], query: str) -> Tuple[IssueEntities, str]:
+    """Split the one-shot output into entities and answer, None if it timed out."""
+    if result is None:
+        return fallback_entities(query), None
+    entities_intents = IssueEntities(
+        entities=result["entities"], intents=result["intents"]
+    )
+    return entities_intents, result["answer"]
+
+
+def build_response(
+    entities_intents: IssueEntities, ticket_id: str, subgraph_data: Dict, answer: str
+) -> Dict:
+    """The /ask response; the same shape in both pipeline modes."""
+    return {
+        "entities": entities_intents.entities,
+        "intents": entities_intents.intents,
+        "ticket_id": ticket_id,
+        "subgraph_data": subgraph_data,
+        "answer": answer,
+    }
+
+
+# Full Implementation
+def process_query(query: str, mode: str = PIPELINE_MODE) -> Dict:
+    """Process the full retrieval and question answering workflow."""
+    for event, data in process_query_events(query, stream=False, mode=mode):
+        if event == "done":
+            return data
+
+
+def process_query_events(
+    query: str, stream: bool = True, mode: str = PIPELINE_MODE
+) -> Iterator[Tuple[str, Dict]]:
+    """Run the workflow, yielding (event, data) as each stage finishes.
+
+    Events are "entities", "ticket", "subgraph", "token" (answer chunks, only when
+    streaming) and finally "done" with the same response process_query returns.
+    In one-shot mode the answer arrives inside the JSON of the single LLM call, so
+    it is not streamed and the "entities" event comes after the subgraph.
+    """
+    one_shot = mode == "one_shot"
+
+    # Reuse the response to a near-identical earlier question, as long as none of
+    # the tickets it was answered from has changed in the graph since
+    answer_cache = get_answer_cache()
+    if answer_cache is not None:
+        question_vector = get_retriever().embeddings.embed_query(query)
+        cached = answer_cache.lookup(
+            question_vector, mode, get_retriever().ticket_fingerprints
+        )
+        if cached is not None:
+            print(f"*** Answered from cache: {cached['ticket_id']}")
+            yield "done", cached
+            return
+
+    # 3.2.1: Query Entity Identification and Intent Detection
+    if one_shot:
+        # Retrieval runs on the question as asked, for every intent's fields
+        search_entities, intents = raw_question_entities(query), ONE_SHOT_INTENTS
+    else:
+        try:
+            entities_intents = run_stage("entities", extract_entities, query)
+            print(f"*** Extracted Entities: {entities_intents.entities}")
+            print(f"*** Extracted Intents: {entities_intents.intents}")
+        except Exception as e:
+            print(f"Error extracting entities and intents: {e}")
+            entities_intents = fallback_entities(query)
+        yield "entities", entities_intents.model_dump()
+        search_entities, intents = entities_intents.entities, entities_intents.intents
+
+    # 3.2.2: Embedding-based Retrieval of Sub-graphs
+    ticket_ids = run_stage(
+        "retrieval",
+        get_candidate_ticket_ids,
+        search_entities,
+        fallback=[DEFAULT_TICKET_ID],
+    )
+    ticket_id = ticket_ids[0]
+    print(f"*** Retrieved Ticket IDs: {ticket_ids}")
+    yield "ticket", {"ticket_id": ticket_id}
+
+    if REPHRASE_QUERY and not one_shot:
+        # Logged when it arrives; nothing waits for it
+        rephrase_future = start_stage("rephrase", rephrase_query, query, ticket_id)
+        rephrase_future.add_done_callback(log_rephrased_query)
+
+    subgraph_data, ticket_fingerprints = run_stage(
+        "subgraph",
+        retrieve_subgraph,
+        ticket_ids,
+        intents,
+        fallback=lambda: (subgraph_timeout(ticket_id), {}),
+    )
+    print(f"*** Subgraph Data: {subgraph_data}")
+    yield "subgraph", {"subgraph_data": subgraph_data}
+
+    # 3.2.3: Answer Generation
+    if one_shot:
+        result = run_stage(
+            "answer", generate_one_shot, query, subgraph_data, fallback=None
+        )
+        entities_intents, answer = one_shot_result(result, query)
+        complete = answer is not None
+        print(f"*** Extracted Entities: {entities_intents.entities}")
+        print(f"*** Extracted Intents: {entities_intents.intents}")
+        yield "entities", entities_intents.model_dump()
+    elif stream:
+        answer, complete = yield from stream_answer_events(query, subgraph_data)
+    else:
+        answer = run_stage(
+            "answer", generate_answer, query, subgraph_data, fallback=None
+        )
+        complete = answer is not None
+    degraded = not complete or "error" in subgraph_data
+    if answer is None:
+        answer = NO_ANSWER
+    print(f"*** Generated Answer: {answer}")
+
+    response = build_response(entities_intents, ticket_id, subgraph_data, answer)
+    # Degraded responses are not cached
+    if answer_cache is not None and not degraded:
+        answer_cache.store(
+            query, question_vector, mode, ticket_id, ticket_fingerprints, response
+        )
+    yield "done", response
+
+
+async def aprocess_query(query: str, retriever: AsyncTicketRetriever) -> Dict:
+    """Async version of process_query."""
+    async for event, data in aprocess_query_events(query, retriever, stream=False):
+        if event == "done":
+            return data
+
+
+async def aprocess_query_events(
+    query: str,
+    retriever: AsyncTicketRetriever,
+    stream: bool = True,
+    mode: str = PIPELINE_MODE,
+) -> AsyncIterator[Tuple[str, Dict]]:
+    """Async version of process_query_events, yielding the same events. The LLM is
+    called through ainvoke/astream and Neo4j through the async driver."""
+    one_shot = mode == "one_shot"
+
+    answer_cache = get_answer_cache()
+    if answer_cache is not None:
+        question_vector = await asyncio.to_thread(
+            retriever.embeddings.embed_query, query
+        )
+        # The cache is SQLite, so its queries run off the event loop
+        entry = await asyncio.to_thread(answer_cache.find, question_vector, mode)
+        if entry is not None:
+            cached = await asyncio.to_thread(
+                answer_cache.resolve,
+                entry,
+                await retriever.ticket_fingerprints(list(entry[1])),
+            )
+            if cached is not None:
+                print(f"*** Answered from cache: {cached['ticket_id']}")
+                yield "done", cached
+                return
+
+    # 3.2.1: Query Entity Identification and Intent Detection
+    if one_shot:
+        search_entities, intents = raw_question_entities(query), ONE_SHOT_INTENTS
+    else:
+        try:
+            extracted = await arun_stage(
+                "entities",
+                entity_extractor.aextract(query, extract_entities_with_llm),
+            )
+            entities_intents = IssueEntities(**extracted)
+            print(f"*** Extracted Entities: {entities_intents.entities}")
+            print(f"*** Extracted Intents: {entities_intents.intents}")
+        except Exception as e:
+            print(f"Error extracting entities and intents: {e}")
+            entities_intents = fallback_entities(query)
+        yield "entities", entities_intents.model_dump()
+        search_entities, intents = entities_intents.entities, entities_intents.intents
+
+    # 3.2.2: Embedding-based Retrieval of Sub-graphs
+    ticket_ids = await arun_stage(
+        "retrieval",
+        retriever.get_candidate_ticket_ids(search_entities),
+        fallback=[DEFAULT_TICKET_ID],
+    )
+    ticket_id = ticket_ids[0]
+    print(f"*** Retrieved Ticket IDs: {ticket_ids}")
+    yield "ticket", {"ticket_id": ticket_id}
+
+    if REPHRASE_QUERY and not one_shot:
+        rephrase_task = asyncio.create_task(
+            arun_stage(
+                "rephrase",
+                build_rephrase_chain(query, ticket_id).ainvoke({}),
+                fallback=None,
+            )
+        )
+        _rephrase_tasks.add(rephrase_task)
+        rephrase_task.add_done_callback(log_rephrased_query)
+
+    subgraph_data, ticket_fingerprints = await arun_stage(
+        "subgraph",
+        aretrieve_subgraph(retriever, ticket_ids, intents),
+        fallback=lambda: (subgraph_timeout(ticket_id), {}),
+    )
+    print(f"*** Subgraph Data: {subgraph_data}")
+    yield "subgraph", {"subgraph_data": subgraph_data}
+
+    # 3.2.3: Answer Generation
+    # Ranking the sentences embeds them, which may call the embedding API
+    context = await asyncio.to_thread(
+        pack_context, query, subgraph_data, retriever.embeddings
+    )
+    if one_shot:
+        result = await arun_stage(
+            "answer", agenerate_one_shot(query, context), fallback=None
+        )
+        entities_intents, answer = one_shot_result(result, query)
+        complete = answer is not None
+        print(f"*** Extracted Entities: {entities_intents.entities}")
+        print(f"*** Extracted Intents: {entities_intents.intents}")
+        yield "entities", entities_intents.model_dump()
+    elif stream:
+        async for event, data in astream_answer_events(query, context):
+            if event == "answer":
+                answer, complete = data
+            else:
+                yield event, data
+    else:
+        answer = await arun_stage(
+            "answer", build_answer_chain(query, context).ainvoke({}), fallback=None
+        )
+        complete = answer is not None
+    degraded = not complete or "error" in subgraph_data
+    if answer is None:
+        answer = NO_ANSWER
+    print(f"*** Generated Answer: {answer}")
+
+    response = build_response(entities_intents, ticket_id, subgraph_data, answer)
+    # Degraded responses are not cached
+    if answer_cache is not None and not degraded:
+        await asyncio.to_thread(
+            answer_cache.store,
+            query,
+            question_vector,
+            mode,
+            ticket_id,
+            ticket_fingerprints,
+            response,
+        )
+    yield "done", response
@@ -0,0 +1,500 @@
+# Description: Long-lived ticket retriever shared by 4_rag_chain.py and web/app.py.
+# The Neo4j graph connection and the section vector indexes are attached lazily, once
+# per process, to the indexes built by 3_generate_embeddings_indexes.py. Attaching uses
+# from_existing_index, so the graph is never re-scanned for nodes missing embeddings.
+# With RETRIEVER_BACKEND=local the sections are searched in-process in the snapshot
+# kept by local_index.py, and Neo4j is only queried for subgraph expansion.
+# AsyncTicketRetriever runs the same searches on the async Neo4j driver for asgi_app.py.
+
+from dotenv import load_dotenv
+import os
+import time
+import asyncio
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from neo4j import AsyncGraphDatabase, RoutingControl
+from langchain_neo4j import Neo4jGraph
+from langchain_neo4j.vectorstores.neo4j_vector import remove_lucene_chars
+from langchain_community.vectorstores import Neo4jVector
+from kg_schema import SECTION_INDEXES
+from embedding_cache import EMBEDDING_MODEL, build_embeddings
+from local_index import LocalIndex
+from cypher_templates import SUBGRAPH_TICKETS
+
+# Configure logging to suppress Neo4j warnings
+logging.getLogger("neo4j").setLevel(logging.ERROR)
+
+load_dotenv()
+GOOGLE_API_KEY = os.environ["GOOGLE_API_KEY"]
+NEO4J_URI = os.environ["NEO4J_URI"]
+NEO4J_USERNAME = os.environ["NEO4J_USERNAME"]
+NEO4J_PASSWORD = os.environ["NEO4J_PASSWORD"]
+NEO4J_DATABASE = os.environ["NEO4J_DATABASE"]
+
+DEFAULT_TICKET_ID = "ENT-23000"
+
+# Threads used to run the per-section searches of one question concurrently
+RETRIEVER_WORKERS = int(os.environ.get("RETRIEVER_WORKERS", "8"))
+
+# "neo4j" searches the Neo4j vector and fulltext indexes, "local" the in-process
+# snapshot, refreshed in the background once it is older than the refresh interval
+RETRIEVER_BACKEND = os.environ.get("RETRIEVER_BACKEND", "neo4j")
+LOCAL_INDEX_REFRESH_SECONDS = int(os.environ.get("LOCAL_INDEX_REFRESH_SECONDS", "300"))
+
+# Candidates pulled from each section index, and how their rankings are fused:
+# "rrf" (reciprocal rank fusion) or "weighted" (weighted sum of min-max scores)
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "10"))
+FUSION_METHOD = os.environ.get("FUSION_METHOD", "rrf")
+RRF_K = 60
+FUSION_WEIGHTS = {
+    "vector": float(os.environ.get("FUSION_VECTOR_WEIGHT", "1.0")),
+    "fulltext": float(os.environ.get("FUSION_FULLTEXT_WEIGHT", "0.5")),
+}
+
+# Entity sections extracted from a question, mapped to the label they are searched in
+SECTION_LABELS = {
+    "issue summary": "Summary",
+    "issue description": "IssueDescription",
+    "step to reproduce": "StepReproduce",
+}
+DEFAULT_SECTION_LABEL = "Summary"
+
+
+# Top-k hits of one section's vector or fulltext index with their owning ticket
+VECTOR_SEARCH_QUERY = """
+CALL db.index.vector.queryNodes($index, $k, $embedding)
+YIELD node, score
+RETURN coalesce(node.ticket_code,
+    head([(t:Ticket)-->(node) | t.code])) AS ticket_id, score
+"""
+FULLTEXT_SEARCH_QUERY = """
+CALL db.index.fulltext.queryNodes($index, $query, {limit: $k})
+YIELD node, score
+RETURN coalesce(node.ticket_code,
+    head([(t:Ticket)-->(node) | t.code])) AS ticket_id, score
+"""
+
+# Content fingerprints of the tickets an answer was generated from
+TICKET_FINGERPRINTS_QUERY = """
+UNWIND $ticket_ids AS code
+MATCH (t:Ticket {code: code})
+RETURN t.code AS code, t.fingerprint AS fingerprint
+"""
+
+
+def section_spec(section: str) -> Dict:
+    """Return the SECTION_INDEXES entry an entity section is searched in."""
+    # Default to summary if section not matched
+    label = SECTION_LABELS.get(section, DEFAULT_SECTION_LABEL)
+    return next(spec for spec in SECTION_INDEXES if spec["label"] == label)
+
+
+def retrieval_query(text_property: str) -> str:
+    """Cypher appended to each index search: returns the owning ticket code with
+    the hit, falling back to an anchored hop for nodes loaded without ticket_code."""
+    return f"""
+    RETURN node.`{text_property}` AS text, score,
+        {{ticket_code: coalesce(node.ticket_code,
+            head([(t:Ticket)-->(node) | t.code])), hash: node.hash}} AS metadata
+    """
+
+
+def generate_full_text_query(input: str) -> str:
+    """Generate a full-text search query with fuzzy matching."""
+    words = [el for el in remove_lucene_chars(input).split() if el]
+    full_text_query = " ".join(f"{word}~2" for word in words)
+    return full_text_query.strip()
+
+
+def fuse_rankings(
+    ranked_lists: Dict[Tuple[str, str], List[Tuple[str, float]]],
+    method: str = FUSION_METHOD,
+) -> List[Dict]:
+    """Fuse ranked (ticket_id, score) lists keyed by (section, kind) into one
+    ranking of tickets, each with the rank and raw score it got in every list."""
+    names = [name for name, hits in ranked_lists.items() if hits]
+    tickets = list(
+        dict.fromkeys(ticket for name in names for ticket, _ in ranked_lists[name])
+    )
+    if not tickets:
+        return []
+
+    # Ticket x list matrices of best rank and score; absent entries stay inf / nan
+    position = {ticket: i for i, ticket in enumerate(tickets)}
+    ranks = np.full((len(tickets), len(names)), np.inf)
+    scores = np.full((len(tickets), len(names)), np.nan)
+    for j, name in enumerate(names):
+        for rank, (ticket, score) in enumerate(ranked_lists[name], start=1):
+            i = position[ticket]
+            if rank < ranks[i, j]:
+                ranks[i, j] = rank
+                scores[i, j] = score
+
+    weights = np.array([FUSION_WEIGHTS.get(kind, 1.0) for _, kind in names])
+    if method == "weighted":
+        # Min-max normalise each list so scores from different indexes compare
+        low = np.nanmin(scores, axis=0)
+        span = np.nanmax(scores, axis=0) - low
+        normalised = np.where(span > 0, (scores - low) / np.where(span > 0, span, 1), 1)
+        contributions = weights * np.nan_to_num(normalised, nan=0.0)
+        contributions[np.isnan(scores)] = 0.0
+    else:
+        contributions = weights / (RRF_K + ranks)
+    fused = contributions.sum(axis=1)
+
+    results = []
+    for i in np.argsort(-fused, kind="stable"):
+        evidence = {}
+        for j, (section, kind) in enumerate(names):
+            if np.isfinite(ranks[i, j]):
+                evidence.setdefault(section, {})[kind] = {
+                    "rank": int(ranks[i, j]),
+                    "score": float(scores[i, j]),
+                }
+        results.append(
+            {"ticket_id": tickets[i], "score": float(fused[i]), "evidence": evidence}
+        )
+    return results
+
+
+class TicketRetriever:
+    """Shared graph connection and section vector indexes, built on first use."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._graph = None
+        self._indexes = None
+        self._executor = None
+        self._local_index = None
+        self._refreshing = False
+        self.embeddings = build_embeddings(GOOGLE_API_KEY, EMBEDDING_MODEL)
+
+    @property
+    def graph(self) -> Neo4jGraph:
+        with self._lock:
+            if self._graph is None:
+                # The schema is not needed for retrieval; skip the APOC schema scan
+                self._graph = Neo4jGraph(
+                    url=NEO4J_URI,
+                    username=NEO4J_USERNAME,
+                    password=NEO4J_PASSWORD,
+                    database=NEO4J_DATABASE,
+                    refresh_schema=False,
+                )
+            return self._graph
+
+    @property
+    def indexes(self) -> Dict[str, Neo4jVector]:
+        """Vector stores keyed by label, attached to the existing indexes."""
+        with self._lock:
+            if self._indexes is None:
+                self._indexes = {
+                    spec["label"]: Neo4jVector.from_existing_index(
+                        self.embeddings,
+                        index_name=spec["vector_index"],
+                        search_type="vector",
+                        graph=self.graph,
+                        node_label=spec["label"],
+                        text_node_property=spec["text_property"],
+                        embedding_node_property="embedding",
+                        retrieval_query=retrieval_query(spec["text_property"]),
+                    )
+                    for spec in SECTION_INDEXES
+                }
+            return self._indexes
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=RETRIEVER_WORKERS, thread_name_prefix="retriever"
+                )
+            return self._executor
+
+    @property
+    def local_index(self) -> LocalIndex:
+        """In-process section index; the first use refreshes it from the graph."""
+        with self._lock:
+            if self._local_index is None:
+                # Only published once refreshed, so a failed first refresh is
+                # retried by the next use instead of leaving an empty index
+                local_index = LocalIndex()
+                local_index.refresh(self.graph)
+                self._local_index = local_index
+            return self._local_index
+
+    def refresh_local_index(self):
+        try:
+            self.local_index.refresh(self.graph)
+        finally:
+            self._refreshing = False
+
+    def schedule_local_refresh(self):
+        """Refresh a stale local index on the executor; searches keep using the
+        current snapshot until the new one is swapped in."""
+        local_index = self.local_index
+        with self._lock:
+            if self._refreshing or (
+                time.time() - local_index.refreshed_at < LOCAL_INDEX_REFRESH_SECONDS
+            ):
+                return
+            self._refreshing = True
+        self.executor.submit(self.refresh_local_index)
+
+    def index_for_section(self, section: str) -> Neo4jVector:
+        label = SECTION_LABELS.get(section, DEFAULT_SECTION_LABEL)
+        return self.indexes[label]
+
+    def warm_up(self):
+        """Attach every index and run one search through each of them."""
+        if RETRIEVER_BACKEND == "local":
+            print(f"Local index loaded: {self.local_index.stats()['rows']}")
+            return
+        for vector_index in self.indexes.values():
+            vector_index.similarity_search_with_score("warm up", k=1)
+        print("Retriever warmed up.")
+
+    def health_check(self) -> Dict:
+        """Report whether Neo4j is reachable and the section indexes are online."""
+        if RETRIEVER_BACKEND == "local":
+            try:
+                self.graph.query("RETURN 1")
+            except Exception as e:
+                return {"status": "error", "error": str(e)}
+            stats = self.local_index.stats()
+            healthy = all(stats["rows"].values())
+            return {
+                "status": "ok" if healthy else "degraded",
+                "local_index": stats,
+                "query_embedding_cache": self.embeddings.query_cache.stats(),
+            }
+
+        names = [spec["vector_index"] for spec in SECTION_INDEXES] + [
+            spec["fulltext_index"] for spec in SECTION_INDEXES
+        ]
+        try:
+            rows = self.graph.query(
+                "SHOW INDEXES YIELD name, state WHERE name IN $names RETURN name, state",
+                {"names": names},
+            )
+        except Exception as e:
+            return {"status": "error", "error": str(e)}
+
+        states = {row["name"]: row["state"] for row in rows}
+        indexes = {name: states.get(name, "MISSING") for name in names}
+        healthy = all(state == "ONLINE" for state in indexes.values())
+        return {
+            "status": "ok" if healthy else "degraded",
+            "indexes_attached": self._indexes is not None,
+            "indexes": indexes,
+            "query_embedding_cache": self.embeddings.query_cache.stats(),
+        }
+
+    def search_section(
+        self, section: str, value: str, vector: List[float], k: int
+    ) -> List[Tuple[str, float]]:
+        """Return the top-k (ticket_id, score) vector hits for one entity section."""
+        if RETRIEVER_BACKEND == "local":
+            label = SECTION_LABELS.get(section, DEFAULT_SECTION_LABEL)
+            return self.local_index.search(label, vector, k)
+
+        # Default to summary if section not matched
+        vector_index = self.index_for_section(section)
+
+        results = vector_index.similarity_search_with_score_by_vector(
+            vector, k=k, query=value
+        )
+        # The owning ticket comes back with each hit, no second round trip
+        return [
+            (doc.metadata["ticket_code"], score)
+            for doc, score in results
+            if doc.metadata.get("ticket_code")
+        ]
+
+    def search_fulltext(
+        self, section: str, value: str, k: int
+    ) -> List[Tuple[str, float]]:
+        """Return the top-k (ticket_id, score) fulltext hits for one entity section."""
+        full_text_query = generate_full_text_query(value)
+        if not full_text_query:
+            return []
+
+        rows = self.graph.query(
+            FULLTEXT_SEARCH_QUERY,
+            {
+                "index": section_spec(section)["fulltext_index"],
+                "query": full_text_query,
+                "k": k,
+            },
+        )
+        return [(row["ticket_id"], row["score"]) for row in rows if row["ticket_id"]]
+
+    def retrieve_tickets(
+        self, entities: Dict[str, str], k: int = RETRIEVAL_TOP_K
+    ) -> List[Dict]:
+        """Rank tickets for the extracted entities by fusing the top-k candidates of
+        every section's vector and fulltext index. Each result carries its evidence."""
+        if not entities:
+            return []
+
+        # Embed every entity string in one request, then run all vector and
+        # fulltext searches concurrently so latency is that of the slowest one
+        sections = list(entities.items())
+        vectors = self.embeddings.embed_queries([value for _, value in sections])
+        futures = {}
+        for (section, value), vector in zip(sections, vectors):
+            futures[(section, "vector")] = self.executor.submit(
+                self.search_section, section, value, vector, k
+            )
+            if RETRIEVER_BACKEND != "local":
+                futures[(section, "fulltext")] = self.executor.submit(
+                    self.search_fulltext, section, value, k
+                )
+        if RETRIEVER_BACKEND == "local":
+            self.schedule_local_refresh()
+
+        return fuse_rankings(
+            {name: future.result() for name, future in futures.items()}
+        )
+
+    def get_candidate_ticket_ids(
+        self, entities: Dict[str, str], n: int = SUBGRAPH_TICKETS
+    ) -> List[str]:
+        """Return the IDs of the n best ranked tickets, best first."""
+        ranked = self.retrieve_tickets(entities)
+        return [ticket["ticket_id"] for ticket in ranked[:n]] or [DEFAULT_TICKET_ID]
+
+    def ticket_fingerprints(self, ticket_ids: List[str]) -> Dict[str, Optional[str]]:
+        """Return the content fingerprints 2_create_kg.py stores on each ticket;
+        tickets no longer in the graph are left out."""
+        rows = self.graph.query(TICKET_FINGERPRINTS_QUERY, {"ticket_ids": ticket_ids})
+        return {row["code"]: row["fingerprint"] for row in rows}
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            if self._graph is not None:
+                self._graph.close()
+            self._executor = None
+            self._graph = None
+            self._indexes = None
+            self._local_index = None
+
+
+class AsyncTicketRetriever:
+    """Async counterpart of TicketRetriever on the async Neo4j driver.
+
+    Create it inside the event loop that uses it. Embeddings and the local
+    index are shared with the process's TicketRetriever.
+    """
+
+    def __init__(self):
+        self.driver = AsyncGraphDatabase.driver(
+            NEO4J_URI, auth=(NEO4J_USERNAME, NEO4J_PASSWORD)
+        )
+        self.retriever = get_retriever()
+        self.embeddings = self.retriever.embeddings
+
+    async def query(self, cypher_query: str, params: Dict = None) -> List[Dict]:
+        records, _, _ = await self.driver.execute_query(
+            cypher_query,
+            params or {},
+            database_=NEO4J_DATABASE,
+            routing_=RoutingControl.READ,
+        )
+        return [record.data() for record in records]
+
+    async def search_section(
+        self, section: str, value: str, vector: List[float], k: int
+    ) -> List[Tuple[str, float]]:
+        """Return the top-k (ticket_id, score) vector hits for one entity section."""
+        spec = section_spec(section)
+        if RETRIEVER_BACKEND == "local":
+            return self.retriever.local_index.search(spec["label"], vector, k)
+        rows = await self.query(
+            VECTOR_SEARCH_QUERY,
+            {"index": spec["vector_index"], "k": k, "embedding": vector},
+        )
+        return [(row["ticket_id"], row["score"]) for row in rows if row["ticket_id"]]
+
+    async def search_fulltext(
+        self, section: str, value: str, k: int
+    ) -> List[Tuple[str, float]]:
+        """Return the top-k (ticket_id, score) fulltext hits for one entity section."""
+        full_text_query = generate_full_text_query(value)
+        if not full_text_query:
+            return []
+        rows = await self.query(
+            FULLTEXT_SEARCH_QUERY,
+            {
+                "index": section_spec(section)["fulltext_index"],
+                "query": full_text_query,
+                "k": k,
+            },
+        )
+        return [(row["ticket_id"], row["score"]) for row in rows if row["ticket_id"]]
+
+    async def retrieve_tickets(
+        self, entities: Dict[str, str], k: int = RETRIEVAL_TOP_K
+    ) -> List[Dict]:
+        """Same ranking as TicketRetriever.retrieve_tickets, with concurrent queries."""
+        if not entities:
+            return []
+
+        sections = list(entities.items())
+        vectors = await asyncio.to_thread(
+            self.embeddings.embed_queries, [value for _, value in sections]
+        )
+        searches = {}
+        for (section, value), vector in zip(sections, vectors):
+            searches[(section, "vector")] = self.search_section(
+                section, value, vector, k
+            )
+            if RETRIEVER_BACKEND != "local":
+                searches[(section, "fulltext")] = self.search_fulltext(
+                    section, value, k
+                )
+        if RETRIEVER_BACKEND == "local":
+            self.retriever.schedule_local_refresh()
+
+        results = await asyncio.gather(*searches.values())
+        return fuse_rankings(dict(zip(searches, results)))
+
+    async def get_candidate_ticket_ids(
+        self, entities: Dict[str, str], n: int = SUBGRAPH_TICKETS
+    ) -> List[str]:
+        ranked = await self.retrieve_tickets(entities)
+        return [ticket["ticket_id"] for ticket in ranked[:n]] or [DEFAULT_TICKET_ID]
+
+    async def ticket_fingerprints(
+        self, ticket_ids: List[str]
+    ) -> Dict[str, Optional[str]]:
+        rows = await self.query(TICKET_FINGERPRINTS_QUERY, {"ticket_ids": ticket_ids})
+        return {row["code"]: row["fingerprint"] for row in rows}
+
+    async def close(self):
+        await self.driver.close()
+
+
+_retriever = None
+_retriever_pid = None
+_retriever_lock = threading.Lock()
+
+
+def get_retriever() -> TicketRetriever:
+    """Return the retriever of the current process, creating it on first use.
+
+    The owning pid is recorded so a worker forked from a process that already
+    built a retriever gets its own connections instead of sharing sockets.
+    """
+    global _retriever, _retriever_pid
+    with _retriever_lock:
+        if _retriever is None or _retriever_pid != os.getpid():
+            _retriever = TicketRetriever()
+            _retriever_pid = os.getpid()
+        return _retriever
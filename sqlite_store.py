@@ -0,0 +1,53 @@
+# Description: SQLite plumbing shared by the answer cache and the query embedding
+# store. Each keeps one table in a database shared by every worker process (WAL mode
+# lets them read while one writes), bounded in size and age: rows older than the TTL
+# and the least recently hit rows past max_entries are evicted on every write.
+
+import os
+import sqlite3
+import threading
+
+
+class SQLiteStore:
+    """Base of a size-bounded, expiring SQLite table; subclasses create `table`
+    with created_at and last_hit_at columns."""
+
+    table = None
+
+    def __init__(self, path: str, max_entries: int, ttl_seconds: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # One connection per process, shared by its threads under self._lock
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+
+    def _create_last_hit_index(self, connection: sqlite3.Connection):
+        connection.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.table}_last_hit "
+            f"ON {self.table} (last_hit_at)"
+        )
+
+    def _evict(self, connection: sqlite3.Connection, now: float):
+        """Delete expired rows, then the least recently hit past max_entries."""
+        connection.execute(
+            f"DELETE FROM {self.table} WHERE created_at <= ?", (now - self.ttl_seconds,)
+        )
+        connection.execute(
+            f"""
+            DELETE FROM {self.table} WHERE rowid IN (
+                SELECT rowid FROM {self.table}
+                ORDER BY last_hit_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        )
+
+    def __len__(self) -> int:
+        with self._lock:
+            query = f"SELECT count(*) FROM {self.table}"
+            return self._connection.execute(query).fetchone()[0]
@@ -0,0 +1,215 @@
+# Description: Per-stage latency budgets for process_query.
+# Each stage runs on a thread pool and is waited on for at most its budget
+# (STAGE_BUDGET_<STAGE> seconds, 0 for no limit). A stage over budget is abandoned
+# and the caller's fallback is used, so one slow LLM or database call cannot hold a
+# request past the sum of the budgets. A running call cannot be interrupted, so the
+# LLM stages get their own bounded pool: abandoned LLM calls can only fill that one,
+# never the pool of the retrieval and subgraph stages. The budget is charged from
+# the moment a worker picks the stage up; time spent queued is logged instead.
+# Streamed stages bound every read by what is left of the budget, so a stream that
+# stalls between chunks is abandoned like a call that never returns.
+
+from dotenv import load_dotenv
+import os
+import time
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import AsyncIterator, Awaitable, Callable, Iterator
+
+load_dotenv()
+
+DEFAULT_STAGE_BUDGETS = {
+    "entities": 10.0,
+    "retrieval": 5.0,
+    "rephrase": 5.0,
+    "subgraph": 5.0,
+    "answer": 30.0,
+}
+STAGE_BUDGETS = {
+    stage: float(os.environ.get(f"STAGE_BUDGET_{stage.upper()}", default))
+    for stage, default in DEFAULT_STAGE_BUDGETS.items()
+}
+STAGE_WORKERS = int(os.environ.get("STAGE_WORKERS", "16"))
+LLM_STAGE_WORKERS = int(os.environ.get("LLM_STAGE_WORKERS", "8"))
+LLM_STAGES = {"entities", "rephrase", "answer"}
+
+# Queue waits longer than this are logged as a saturated pool
+STAGE_QUEUE_WARNING_SECONDS = 0.1
+
+# Marks a stage called without a fallback: exceeding the budget raises instead
+NO_FALLBACK = object()
+# Put after the last item of a streamed stage
+STREAM_END = object()
+
+
+class StageBudgetExceeded(TimeoutError):
+    """A stage did not finish within its latency budget."""
+
+
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+def get_stage_executor(stage: str) -> ThreadPoolExecutor:
+    """Return the pool of a stage: one for the LLM stages, one for the others."""
+    pool = "llm" if stage in LLM_STAGES else "data"
+    with _executor_lock:
+        if pool not in _executors:
+            _executors[pool] = ThreadPoolExecutor(
+                max_workers=LLM_STAGE_WORKERS if pool == "llm" else STAGE_WORKERS,
+                thread_name_prefix=f"stage-{pool}",
+            )
+        return _executors[pool]
+
+
+def start_stage(stage: str, fn: Callable, *args) -> Future:
+    """Start a stage in the background; collect it later with finish_stage."""
+    running = threading.Event()
+    timing = {"submitted": time.perf_counter()}
+
+    def run():
+        timing["started"] = time.perf_counter()
+        running.set()
+        queued = timing["started"] - timing["submitted"]
+        if queued > STAGE_QUEUE_WARNING_SECONDS:
+            print(f"*** Stage {stage} waited {queued * 1000:.0f} ms for a worker")
+        return fn(*args)
+
+    future = get_stage_executor(stage).submit(run)
+    future.stage_running = running
+    future.stage_timing = timing
+    return future
+
+
+def exceed_budget(stage: str, budget: float, fallback):
+    print(f"*** Stage {stage} exceeded its {budget:.1f}s budget")
+    if fallback is NO_FALLBACK:
+        raise StageBudgetExceeded(f"{stage} exceeded its {budget:.1f}s budget")
+    return fallback() if callable(fallback) else fallback
+
+
+def finish_stage(stage: str, future: Future, fallback=NO_FALLBACK):
+    """Wait for a started stage for what is left of its budget.
+
+    The budget starts when a worker picks the stage up. A stage still queued after
+    a whole budget is cancelled; one running past its budget is abandoned. Either
+    way the fallback is returned, or StageBudgetExceeded raised when there is none.
+    Exceptions raised by the stage itself propagate unchanged.
+    """
+    budget = STAGE_BUDGETS.get(stage, 0)
+    remaining = None
+    if budget:
+        if not future.stage_running.wait(budget):
+            if future.cancel():
+                print(f"*** Stage {stage} found no free worker, its pool is saturated")
+                return exceed_budget(stage, budget, fallback)
+            # Picked up just now
+            future.stage_running.wait()
+        elapsed = time.perf_counter() - future.stage_timing["started"]
+        remaining = max(0.0, budget - elapsed)
+    try:
+        result = future.result(timeout=remaining)
+    except TimeoutError:
+        # The call keeps its worker until it returns
+        return exceed_budget(stage, budget, fallback)
+    elapsed = time.perf_counter() - future.stage_timing["started"]
+    print(f"*** Stage {stage} took {elapsed * 1000:.0f} ms")
+    return result
+
+
+def run_stage(stage: str, fn: Callable, *args, fallback=NO_FALLBACK):
+    """Run a stage and wait for it within its budget."""
+    return finish_stage(stage, start_stage(stage, fn, *args), fallback)
+
+
+async def arun_stage(stage: str, awaitable: Awaitable, fallback=NO_FALLBACK):
+    """Await a stage within its budget; past it the stage is cancelled."""
+    budget = STAGE_BUDGETS.get(stage, 0)
+    start = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(awaitable, timeout=budget or None)
+    except asyncio.TimeoutError:
+        return exceed_budget(stage, budget, fallback)
+    print(f"*** Stage {stage} took {(time.perf_counter() - start) * 1000:.0f} ms")
+    return result
+
+
+def stream_stage(stage: str, fn: Callable, *args) -> Iterator:
+    """Iterate what fn returns on the stage's pool and yield its items within the
+    budget. Each item is waited on for at most what is left of the budget; past it
+    StageBudgetExceeded is raised and the stream is dropped at its next item.
+    Exceptions raised by the stream itself propagate unchanged.
+    """
+    budget = STAGE_BUDGETS.get(stage, 0)
+    items = queue.Queue()
+    stopped = threading.Event()
+
+    def pump():
+        try:
+            for item in fn(*args):
+                if stopped.is_set():
+                    break
+                items.put(item)
+        finally:
+            items.put(STREAM_END)
+
+    future = start_stage(stage, pump)
+    try:
+        deadline = None
+        if budget:
+            if not future.stage_running.wait(budget):
+                if future.cancel():
+                    print(
+                        f"*** Stage {stage} found no free worker, its pool is saturated"
+                    )
+                    exceed_budget(stage, budget, NO_FALLBACK)
+                # Picked up just now
+                future.stage_running.wait()
+            deadline = future.stage_timing["started"] + budget
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    exceed_budget(stage, budget, NO_FALLBACK)
+            try:
+                item = items.get(timeout=remaining)
+            except queue.Empty:
+                # The stream keeps its worker until its next item arrives
+                exceed_budget(stage, budget, NO_FALLBACK)
+            if item is STREAM_END:
+                break
+            yield item
+    finally:
+        stopped.set()
+    future.result()
+    elapsed = time.perf_counter() - future.stage_timing["started"]
+    print(f"*** Stage {stage} took {elapsed * 1000:.0f} ms")
+
+
+async def astream_stage(stage: str, stream: AsyncIterator) -> AsyncIterator:
+    """Async version of stream_stage: each item is awaited for at most what is left
+    of the budget, past which the stream is cancelled."""
+    budget = STAGE_BUDGETS.get(stage, 0)
+    start = time.perf_counter()
+    iterator = stream.__aiter__()
+    try:
+        while True:
+            remaining = None
+            if budget:
+                remaining = budget - (time.perf_counter() - start)
+                if remaining <= 0:
+                    exceed_budget(stage, budget, NO_FALLBACK)
+            try:
+                item = await asyncio.wait_for(iterator.__anext__(), timeout=remaining)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                exceed_budget(stage, budget, NO_FALLBACK)
+            yield item
+    finally:
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+    print(f"*** Stage {stage} took {(time.perf_counter() - start) * 1000:.0f} ms")
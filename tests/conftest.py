@@ -0,0 +1,12 @@
+# Tests run offline: the local fake embedder and throwaway cache directories
+import os
+import sys
+import tempfile
+
+os.environ["EMBEDDING_BACKEND"] = "fake"
+os.environ.setdefault(
+    "EMBEDDING_CACHE_DIR", tempfile.mkdtemp(prefix="embedding_cache_")
+)
+
+# Shared pipeline modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
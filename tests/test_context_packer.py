@@ -0,0 +1,24 @@
+from context_packer import pack_context
+
+
+def test_related_tickets_short_fields_are_not_pinned():
+    codes = [f"TCK-{i:03d}" for i in range(8)]
+    subgraph_data = {
+        "title": "Login is slow",
+        "summary": "Users wait a minute to log in.",
+        "priority": "High",
+        "related_tickets": [
+            {
+                "ticket_id": f"TCK-9{i}",
+                "candidate": False,
+                "priority": "Low",
+                "similar_tickets": codes,
+            }
+            for i in range(10)
+        ],
+    }
+
+    context = pack_context("why is login slow", subgraph_data, budget=60)
+
+    # The related tickets' lists alone would fill the budget
+    assert "Summary: Users wait a minute to log in." in context.splitlines()
@@ -0,0 +1,152 @@
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+from embedding_cache import (
+    CachedEmbeddings,
+    DeterministicEmbeddings,
+    EmbeddingCache,
+    QueryEmbeddingStore,
+    build_embeddings,
+)
+
+DIMENSIONS = 8
+
+
+class CountingEmbeddings(DeterministicEmbeddings):
+    """Fake embedder that records every text sent to it."""
+
+    def __init__(self, dimensions: int = DIMENSIONS):
+        super().__init__(dimensions)
+        self.calls = []
+
+    def embed_documents(self, texts, **kwargs):
+        self.calls.append((list(texts), kwargs.get("task_type")))
+        return super().embed_documents(texts)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return EmbeddingCache(str(tmp_path), DIMENSIONS)
+
+
+@pytest.fixture
+def embedder():
+    return CountingEmbeddings()
+
+
+def test_miss_then_hit(cache, embedder):
+    embeddings = CachedEmbeddings(embedder, "model-a", cache)
+
+    first = embeddings.embed_documents(["alpha", "beta", "alpha"])
+    assert embedder.calls == [(["alpha", "beta"], "retrieval_document")]
+
+    second = embeddings.embed_documents(["beta", "alpha"])
+    assert len(embedder.calls) == 1
+    assert second == [first[1], first[0]]
+    assert np.allclose(first[0], DeterministicEmbeddings(DIMENSIONS)._embed("alpha"))
+
+
+def test_only_missing_texts_are_embedded(cache, embedder):
+    embeddings = CachedEmbeddings(embedder, "model-a", cache)
+    embeddings.embed_documents(["alpha"])
+    embeddings.embed_documents(["alpha", "gamma"])
+    assert embedder.calls[-1] == (["gamma"], "retrieval_document")
+
+
+def test_keys_are_separated_by_model_and_task_type(cache):
+    vector = [1.0] * DIMENSIONS
+    cache.put("model-a", "retrieval_document", "alpha", vector)
+
+    assert cache.get("model-a", "retrieval_document", "alpha") == vector
+    assert cache.get("model-b", "retrieval_document", "alpha") is None
+    assert cache.get("model-a", "retrieval_query", "alpha") is None
+
+
+def test_new_instance_reloads_from_disk(tmp_path, embedder):
+    embeddings = CachedEmbeddings(
+        embedder, "model-a", EmbeddingCache(str(tmp_path), DIMENSIONS)
+    )
+    expected = embeddings.embed_documents(["alpha"])
+
+    reloaded = CachedEmbeddings(
+        embedder, "model-a", EmbeddingCache(str(tmp_path), DIMENSIONS)
+    )
+    assert reloaded.embed_documents(["alpha"]) == expected
+    assert len(embedder.calls) == 1
+
+
+def test_rows_written_by_another_process_are_picked_up(cache, tmp_path):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = (
+        "import sys; sys.path.insert(0, sys.argv[1]);"
+        "from embedding_cache import EmbeddingCache;"
+        f"EmbeddingCache(sys.argv[2], {DIMENSIONS})"
+        f".put('model-a', 'retrieval_document', 'alpha', [2.0] * {DIMENSIONS})"
+    )
+    assert cache.get("model-a", "retrieval_document", "alpha") is None
+
+    subprocess.run([sys.executable, "-c", script, root, str(tmp_path)], check=True)
+
+    assert cache.get("model-a", "retrieval_document", "alpha") == [2.0] * DIMENSIONS
+
+
+def test_torn_append_does_not_misalign_later_rows(cache, tmp_path):
+    cache.put("m", "t", "a", [1.0] * DIMENSIONS)
+    # A run killed in the middle of an append
+    with open(os.path.join(tmp_path, "vectors.f32"), "ab") as file:
+        file.write(np.zeros(2, dtype=np.float32).tobytes())
+    with open(os.path.join(tmp_path, "index.tsv"), "a", encoding="utf-8") as file:
+        file.write("m\tt\tpartial")
+
+    cache.put("m", "t", "b", [2.0] * DIMENSIONS)
+    cache.put("m", "t", "c", [3.0] * DIMENSIONS)
+
+    reloaded = EmbeddingCache(str(tmp_path), DIMENSIONS)
+    assert reloaded.get("m", "t", "a") == [1.0] * DIMENSIONS
+    assert reloaded.get("m", "t", "b") == [2.0] * DIMENSIONS
+    assert reloaded.get("m", "t", "c") == [3.0] * DIMENSIONS
+
+
+def test_queries_are_shared_through_the_store_not_the_cache(cache, embedder, tmp_path):
+    store = QueryEmbeddingStore(str(tmp_path / "queries.sqlite3"))
+    first = CachedEmbeddings(embedder, "model-a", cache, query_store=store)
+    expected = first.embed_query("Login  is SLOW")
+
+    # Another worker, with its own empty in-memory tier
+    second = CachedEmbeddings(embedder, "model-a", cache, query_store=store)
+    assert second.embed_query("login is slow") == expected
+    assert embedder.calls == [(["Login  is SLOW"], "retrieval_query")]
+    assert len(cache) == 0
+
+
+def test_queries_are_embedded_as_asked(cache, embedder):
+    embeddings = CachedEmbeddings(embedder, "model-a", cache)
+    first, second = embeddings.embed_queries(["Is login SLOW?", "is login slow?"])
+    assert first == second
+    assert embedder.calls == [(["Is login SLOW?"], "retrieval_query")]
+
+
+def test_query_store_evicts_least_recently_hit(tmp_path):
+    store = QueryEmbeddingStore(str(tmp_path / "queries.sqlite3"), max_entries=2)
+    store.put_many("m", ["a", "b"], [[1.0], [2.0]])
+    store.get_many("m", ["a"])
+    store.put_many("m", ["c"], [[3.0]])
+
+    assert len(store) == 2
+    assert store.get_many("m", ["a", "b", "c"]) == [[1.0], None, [3.0]]
+
+
+def test_query_store_entries_expire(tmp_path):
+    store = QueryEmbeddingStore(str(tmp_path / "queries.sqlite3"), ttl_seconds=0)
+    store.put_many("m", ["a"], [[1.0]])
+    assert store.get_many("m", ["a"]) == [None]
+
+
+def test_build_embeddings_uses_the_fake_backend():
+    embeddings = build_embeddings("unused-key")
+    assert isinstance(embeddings.embeddings, DeterministicEmbeddings)
+    vectors = embeddings.embed_documents(["alpha", "alpha"])
+    assert vectors[0] == vectors[1]
+    assert embeddings.cache.get(embeddings.model, "retrieval_document", "alpha")
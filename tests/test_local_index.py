@@ -0,0 +1,66 @@
+import os
+import numpy as np
+import pytest
+from local_index import SectionIndex
+
+DIMENSIONS = 4
+
+
+class FakeGraph:
+    """Stands in for Neo4jGraph with a fixed set of section nodes."""
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def query(self, cypher, params=None):
+        if params is None:
+            return [
+                {"hash": node_hash, "ticket_code": code}
+                for node_hash, (code, _) in self.nodes.items()
+            ]
+        return [
+            {"hash": node_hash, "embedding": self.nodes[node_hash][1]}
+            for node_hash in params["hashes"]
+        ]
+
+
+def node(code, axis):
+    vector = [0.0] * DIMENSIONS
+    vector[axis] = 1.0
+    return code, vector
+
+
+def top_code(index, axis):
+    return index.search(node("", axis)[1], 1)[0][0]
+
+
+def test_interrupted_compaction_keeps_rows_and_vectors_consistent(
+    tmp_path, monkeypatch
+):
+    index = SectionIndex("Summary", str(tmp_path), DIMENSIONS)
+    index.refresh(FakeGraph({f"h{axis}": node(f"T{axis}", axis) for axis in range(4)}))
+
+    # Three of four rows removed: the refresh compacts, then dies before rows.tsv
+    survivors = FakeGraph({"h3": node("T3", 3)})
+    write_atomic = index._write_atomic
+
+    def crash_on_rows(path, write):
+        if path == index.rows_path:
+            raise OSError("killed")
+        write_atomic(path, write)
+
+    monkeypatch.setattr(index, "_write_atomic", crash_on_rows)
+    with pytest.raises(OSError):
+        index.refresh(survivors)
+
+    reloaded = SectionIndex("Summary", str(tmp_path), DIMENSIONS)
+    assert [top_code(reloaded, axis) for axis in range(4)] == ["T0", "T1", "T2", "T3"]
+
+    reloaded.refresh(survivors)
+    assert top_code(reloaded, 3) == "T3"
+    assert len(reloaded.snapshot) == 1
+    vector_files = [
+        name for name in os.listdir(reloaded.directory) if name.endswith(".f32")
+    ]
+    assert vector_files == ["vectors.1.f32"]
+    assert np.asarray(reloaded.snapshot.matrix).shape == (1, DIMENSIONS)
@@ -0,0 +1,43 @@
+import asyncio
+import time
+import pytest
+import stage_budget
+from stage_budget import StageBudgetExceeded, astream_stage, stream_stage
+
+
+@pytest.fixture(autouse=True)
+def short_answer_budget(monkeypatch):
+    monkeypatch.setitem(stage_budget.STAGE_BUDGETS, "answer", 0.2)
+
+
+def test_stalled_stream_is_cut_at_the_budget():
+    def stalled():
+        yield "first"
+        time.sleep(2)
+        yield "late"
+
+    chunks = []
+    start = time.perf_counter()
+    with pytest.raises(StageBudgetExceeded):
+        for chunk in stream_stage("answer", stalled):
+            chunks.append(chunk)
+    assert chunks == ["first"]
+    assert time.perf_counter() - start < 1
+
+
+def test_stalled_async_stream_is_cut_at_the_budget():
+    async def stalled():
+        yield "first"
+        await asyncio.sleep(2)
+        yield "late"
+
+    async def collect(chunks):
+        async for chunk in astream_stage("answer", stalled()):
+            chunks.append(chunk)
+
+    chunks = []
+    start = time.perf_counter()
+    with pytest.raises(StageBudgetExceeded):
+        asyncio.run(collect(chunks))
+    assert chunks == ["first"]
+    assert time.perf_counter() - start < 1
@@ -0,0 +1,128 @@
+import csv
+import importlib
+import json
+import os
+import pytest
+
+# 2_create_kg.py reads its connection settings at import time; the graph tests run
+# against a throwaway database named by NEO4J_TEST_URI and are skipped without one
+NEO4J_TEST_URI = os.environ.get("NEO4J_TEST_URI")
+NEO4J_TEST_DATABASE = os.environ.get("NEO4J_TEST_DATABASE", "neo4j")
+os.environ.setdefault("AURA_INSTANCENAME", "test")
+os.environ.setdefault("NEO4J_URI", NEO4J_TEST_URI or "bolt://localhost:7687")
+os.environ.setdefault("NEO4J_USERNAME", "neo4j")
+os.environ.setdefault("NEO4J_PASSWORD", "")
+os.environ.setdefault("NEO4J_DATABASE", NEO4J_TEST_DATABASE)
+os.environ.setdefault("CSV_FILE_NAME", "unused.csv")
+
+create_kg = importlib.import_module("2_create_kg")
+
+COLUMNS = [
+    "Code",
+    "Title",
+    "Summary",
+    "Issue_Description",
+    "Step_To_Reproduce",
+    "Priority",
+    "Root_Cause",
+    "Impact_Area",
+    "Comments",
+    "Clone_From",
+    "Clone_To",
+    "Similar_To",
+]
+
+
+def ticket(code, similar_to):
+    return {
+        "code": code,
+        "clone_from": [],
+        "clone_to": [],
+        "similar_to": similar_to,
+    }
+
+
+def write_csv(path, similar):
+    with open(path, mode="w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=COLUMNS)
+        writer.writeheader()
+        for code, similar_to in similar.items():
+            writer.writerow(
+                {
+                    "Code": code,
+                    "Title": f"Title of {code}",
+                    "Summary": f"Summary of {code}.",
+                    "Issue_Description": f"Description of {code}.",
+                    "Step_To_Reproduce": f"1. Open {code}.",
+                    "Priority": "High",
+                    "Root_Cause": "Data issue",
+                    "Impact_Area": "Login",
+                    "Comments": f"Comments on {code}.",
+                    "Clone_From": "[]",
+                    "Clone_To": "[]",
+                    "Similar_To": json.dumps(similar_to),
+                }
+            )
+    return str(path)
+
+
+def test_pairs_listed_only_by_unchanged_tickets_are_requeued():
+    edges = create_kg.PendingEdges()
+    # D and U are unchanged; C changed and dropped both of them
+    edges.requeue_similar([ticket("D", ["C"]), ticket("U", [])], [])
+    edges.mark_loaded(["D", "U"])
+    assert edges.take_ready()["similar_to"] == []
+
+    edges.add_rows([ticket("C", [])])
+    edges.requeue_similar([], ["C"])
+    edges.mark_loaded(["C"])
+    assert edges.take_ready()["similar_to"] == [{"source": "C", "target": "D"}]
+
+
+@pytest.fixture
+def driver(monkeypatch):
+    if not NEO4J_TEST_URI:
+        pytest.skip("NEO4J_TEST_URI is not set")
+    # Never the database configured in .env: the test wipes it
+    monkeypatch.setattr(create_kg, "NEO4J_DATABASE", NEO4J_TEST_DATABASE)
+    driver = create_kg.GraphDatabase.driver(
+        NEO4J_TEST_URI,
+        auth=(
+            os.environ.get("NEO4J_TEST_USERNAME", "neo4j"),
+            os.environ.get("NEO4J_TEST_PASSWORD", ""),
+        ),
+    )
+    create_kg.bootstrap_schema(driver, NEO4J_TEST_DATABASE)
+    yield driver
+    driver.close()
+
+
+def clear_graph(driver):
+    with driver.session(database=NEO4J_TEST_DATABASE) as session:
+        session.run("MATCH (n) WHERE NOT n:SchemaVersion DETACH DELETE n")
+
+
+def similar_edges(driver):
+    with driver.session(database=NEO4J_TEST_DATABASE) as session:
+        result = session.run(
+            "MATCH (a:Ticket)-[:SIMILAR_TO]->(b:Ticket) RETURN a.code AS a, b.code AS b"
+        )
+        return {(record["a"], record["b"]) for record in result}
+
+
+def test_sync_drops_similar_links_like_a_full_reload(driver, tmp_path):
+    before = write_csv(tmp_path / "before.csv", {"C": ["U", "D"], "D": ["C"], "U": []})
+    # C no longer lists U nor D; D still lists C, U never listed C
+    after = write_csv(tmp_path / "after.csv", {"C": [], "D": ["C"], "U": []})
+
+    clear_graph(driver)
+    create_kg.load_tickets(driver, before)
+    create_kg.sync_tickets(driver, after)
+    synced = similar_edges(driver)
+
+    clear_graph(driver)
+    create_kg.load_tickets(driver, after)
+    reloaded = similar_edges(driver)
+    clear_graph(driver)
+
+    assert synced == reloaded == {("C", "D"), ("D", "C")}
@@ -0,0 +1,165 @@
+# Description: Async (ASGI) serving mode for the question answering app.
+# Serves the same routes and /ask JSON contract as app.py, but every request is a
+# coroutine: the LLM is called through ainvoke/astream and Neo4j through the async
+# driver, so one worker keeps many requests in flight instead of one per thread.
+# At most ASGI_MAX_IN_FLIGHT requests run at once per worker; the others wait up to
+# ASGI_QUEUE_TIMEOUT seconds for a slot and are then refused with 503 (backpressure;
+# an "error" event on /ask/stream, whose slot is only taken once it is streamed),
+# and a request still running after ASGI_REQUEST_TIMEOUT seconds gets a 504.
+# Run (from web/): `uvicorn asgi_app:app --host 0.0.0.0 --port 5000 --workers 4`
+
+import os
+import json
+import time
+import asyncio
+import contextlib
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+# Importing app also puts the repository root on the path for the shared pipeline
+from app import format_sse
+from pipeline import (
+    aprocess_query,
+    aprocess_query_events,
+    entity_extractor,
+    get_answer_cache,
+)
+from retriever import RETRIEVER_BACKEND, AsyncTicketRetriever, get_retriever
+
+ASGI_MAX_IN_FLIGHT = int(os.environ.get("ASGI_MAX_IN_FLIGHT", "64"))
+ASGI_QUEUE_TIMEOUT = float(os.environ.get("ASGI_QUEUE_TIMEOUT", "2"))
+ASGI_REQUEST_TIMEOUT = float(os.environ.get("ASGI_REQUEST_TIMEOUT", "60"))
+
+TEMPLATE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "templates", "index.html"
+)
+
+
+async def acquire_slot(request: Request) -> bool:
+    """Take one of the worker's in-flight slots, waiting up to ASGI_QUEUE_TIMEOUT."""
+    try:
+        await asyncio.wait_for(
+            request.app.state.in_flight.acquire(), timeout=ASGI_QUEUE_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+def release_slot(request: Request):
+    request.app.state.in_flight.release()
+
+
+def busy_response() -> JSONResponse:
+    return JSONResponse(
+        {"error": "Server is busy, please retry"},
+        status_code=503,
+        headers={"Retry-After": "1"},
+    )
+
+
+async def read_question(request: Request):
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        return None
+    return data.get("question") if isinstance(data, dict) else None
+
+
+async def index(request: Request):
+    return FileResponse(TEMPLATE_PATH)
+
+
+async def ask(request: Request):
+    question = await read_question(request)
+    if not question:
+        return JSONResponse({"error": "No question provided"}, status_code=400)
+
+    if not await acquire_slot(request):
+        return busy_response()
+    try:
+        response = await asyncio.wait_for(
+            aprocess_query(question, request.app.state.retriever),
+            timeout=ASGI_REQUEST_TIMEOUT,
+        )
+    except asyncio.TimeoutError:
+        return JSONResponse({"error": "Request timed out"}, status_code=504)
+    finally:
+        release_slot(request)
+    return JSONResponse(response)
+
+
+async def ask_stream(request: Request):
+    question = await read_question(request)
+    if not question:
+        return JSONResponse({"error": "No question provided"}, status_code=400)
+
+    async def events():
+        # The slot is taken once the response is iterated, so a client gone before
+        # that never holds one; a busy worker answers with an "error" event instead
+        if not await acquire_slot(request):
+            yield format_sse("error", {"error": "Server is busy, please retry"})
+            return
+        deadline = time.monotonic() + ASGI_REQUEST_TIMEOUT
+        stream = aprocess_query_events(question, request.app.state.retriever)
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                event, payload = await asyncio.wait_for(
+                    stream.__anext__(), timeout=max(remaining, 0)
+                )
+                yield format_sse(event, payload)
+        except StopAsyncIteration:
+            pass
+        except asyncio.TimeoutError:
+            yield format_sse("error", {"error": "Request timed out"})
+        except Exception as e:
+            print(f"Error streaming answer: {e}")
+            yield format_sse("error", {"error": "An error occurred. Please try again."})
+        finally:
+            await stream.aclose()
+            release_slot(request)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Stop proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def health(request: Request):
+    status = await asyncio.to_thread(get_retriever().health_check)
+    if get_answer_cache() is not None:
+        status["answer_cache"] = get_answer_cache().stats()
+    status["entity_extractor"] = entity_extractor.stats()
+    return JSONResponse(status, status_code=200 if status["status"] == "ok" else 503)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette):
+    # The async driver and the semaphore belong to this worker's event loop
+    app.state.retriever = AsyncTicketRetriever()
+    app.state.in_flight = asyncio.Semaphore(ASGI_MAX_IN_FLIGHT)
+    if RETRIEVER_BACKEND == "local":
+        await asyncio.to_thread(get_retriever().warm_up)
+    yield
+    await app.state.retriever.close()
+
+
+app = Starlette(
+    routes=[
+        Route("/", index),
+        Route("/ask", ask, methods=["POST"]),
+        Route("/ask/stream", ask_stream, methods=["POST"]),
+        Route("/health", health),
+    ],
+    lifespan=lifespan,
+)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run("asgi_app:app", host="0.0.0.0", port=5000, workers=4)